@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+
+"""Running weighted average of client updates.
+
+The server folds every update into per-layer accumulators as soon as it
+arrives instead of keeping the whole cohort around. This means memory is
+O(model) rather than O(clients x model). Dense layers are scaled into a
+single scratch buffer that all layers share, and then added in place.
+Sparse layers only touch the entries the client actually sent.
+
+Once a round is aggregated, ``model_delta`` records which entries of the
+global model changed. A model that still holds the previous global version
+can then be brought up to date by scattering only those entries.
+"""
+
+from typing import NamedTuple
+import numpy as np
+
+from compressors import SparseUpdate, get_precision
+
+
+# Layers with more changed entries than this fraction are loaded whole
+DELTA_DENSITY = 0.1
+
+
+class WeightedAggregator:
+    """Accumulates ``sum(weight * update)`` over a round.
+
+    Parameters
+    ----------
+    shapes : list
+        Shapes of the model's layers
+    dtypes : list
+        Dtypes of the model's layers. The accumulators use the wider of
+        each dtype and the compressors' precision.
+    """
+
+    def __init__(self, shapes, dtypes):
+        self.sums = [np.zeros(shape, dtype=np.result_type(dtype, get_precision()))
+                     for shape, dtype in zip(shapes, dtypes)]
+        self.total_weight = 0.
+        self.count = 0
+        self._scratch = None
+
+    @classmethod
+    def like(cls, update) -> "WeightedAggregator":
+        """Aggregator for updates shaped like the given one."""
+        return cls([v.shape for v in update], [v.dtype for v in update])
+
+    def _scaled(self, v: np.ndarray, weight: float, dtype) -> np.ndarray:
+        """weight * v in dtype, written to the shared scratch buffer."""
+        size = int(np.prod(v.shape))
+        if self._scratch is None or self._scratch.size < size or self._scratch.dtype != dtype:
+            self._scratch = np.empty(max(size, max(s.size for s in self.sums)), dtype=dtype)
+        out = self._scratch[:size].reshape(v.shape)
+        return np.multiply(v, weight, out=out, dtype=dtype)
+
+    def add(self, update, weight: float):
+        """Fold weight * update into the running sums."""
+        assert len(update) == len(self.sums), "update has %d layers, expected %d" % (
+            len(update), len(self.sums))
+        for acc, v in zip(self.sums, update):
+            if isinstance(v, SparseUpdate):
+                v.add_to(acc, weight)
+            else:
+                acc += self._scaled(np.asarray(v), weight, acc.dtype)
+        self.total_weight += weight
+        self.count += 1
+
+    def result(self) -> list:
+        """The weighted average. The accumulators are reused for it, so the
+        aggregator must not be added to afterwards."""
+        for acc in self.sums:
+            acc /= self.total_weight
+        self._scratch = None
+        return self.sums
+
+
+class ModelDelta(NamedTuple):
+    """Entries of the global model that changed in a round.
+
+    ``layers`` holds one entry per layer: either a SparseUpdate with the new
+    values of the changed entries, or None if so many changed that the
+    layer is better loaded whole. The new values are sent rather than
+    differences, so applying a delta to ``base_version`` reproduces the new
+    model exactly.
+    """
+    base_version: int
+    layers: list
+
+
+def model_delta(old, new, base_version: int, max_density: float = DELTA_DENSITY) -> ModelDelta:
+    """Delta from the model with version base_version to the new one."""
+    layers = []
+    for old_layer, new_layer in zip(old, new):
+        new_layer = np.asarray(new_layer)
+        changed = np.flatnonzero(new_layer != np.asarray(old_layer))
+        if changed.size > max_density * new_layer.size:
+            layers.append(None)
+        else:
+            layers.append(SparseUpdate(changed, new_layer.ravel()[changed],
+                                       new_layer.shape, new_layer.dtype))
+    return ModelDelta(base_version, layers)
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+import numpy as np
+
+import compressors
+from aggregation import WeightedAggregator, model_delta
+from compressors import SparseUpdate, TopKCompressor, sparse_kmeans
+
+
+def _updates(rng):
+    shapes = [(20, 30), (30,), (30, 8)]
+    updates = []
+    for _ in range(4):
+        dense = [rng.normal(size=shape).astype(np.float32) for shape in shapes]
+        kmeans, _, _ = sparse_kmeans(dense[2].ravel(), budget=400, sparse=True)
+        updates.append([
+            TopKCompressor.compress_sparse(dense[0].ravel(), k=60).reshape(shapes[0]),
+            dense[1],
+            kmeans.reshape(shapes[2]),
+        ])
+    return updates
+
+
+def test_weighted_aggregator():
+    rng = np.random.default_rng(0)
+    updates = _updates(rng)
+    weights = [3, 1, 7, 2]
+
+    aggregator = WeightedAggregator.like(updates[0])
+    for update, weight in zip(updates, weights):
+        aggregator.add(update, weight)
+    assert aggregator.count == len(updates)
+    assert aggregator.total_weight == sum(weights)
+    average = aggregator.result()
+
+    for i, v in enumerate(average):
+        expected = sum(w * np.asarray(u[i], dtype=np.float64) for u, w in zip(updates, weights))
+        expected /= sum(weights)
+        assert v.shape == expected.shape
+        assert v.dtype == np.float32
+        np.testing.assert_allclose(v, expected, rtol=1e-5, atol=1e-6)
+
+
+def test_weighted_aggregator_precision():
+    rng = np.random.default_rng(1)
+    updates = _updates(rng)
+    compressors.set_precision(np.float64)
+    try:
+        aggregator = WeightedAggregator.like(updates[0])
+    finally:
+        compressors.set_precision(np.float32)
+    for update in updates:
+        aggregator.add(update, 5)
+    average = aggregator.result()
+    assert all(v.dtype == np.float64 for v in average)
+    for i, v in enumerate(average):
+        expected = np.mean([np.asarray(u[i], dtype=np.float64) for u in updates], axis=0)
+        np.testing.assert_allclose(v, expected, rtol=1e-12)
+
+
+def test_codebook_add_to():
+    rng = np.random.default_rng(2)
+    # A zero centroid that is not label 0, with every entry stored
+    update = SparseUpdate(np.arange(50), rng.integers(0, 4, size=50), (5, 10),
+                          codebook=np.array([-1.5, 0.25, 0, 3.0], dtype=np.float32))
+    out = np.ones((5, 10))
+    update.add_to(out, 3)
+    np.testing.assert_allclose(out, 1 + 3 * update.toarray())
+
+    x = rng.normal(size=200).astype(np.float32)
+    Sx = compressors.SparseTernaryCompressor.compress_sparse(x, k=20)
+    assert Sx.codebook.size == 2 and Sx.values.dtype == np.uint8
+    out = np.zeros(200, dtype=np.float32)
+    Sx.add_to(out, 2)
+    np.testing.assert_allclose(out, 2 * compressors.SparseTernaryCompressor.compress(x, k=20), rtol=1e-6)
+
+
+def test_model_delta():
+    rng = np.random.default_rng(4)
+    old = [rng.normal(size=(30, 20)).astype(np.float32), rng.normal(size=50).astype(np.float32)]
+    new = [v.copy() for v in old]
+    new[0].ravel()[rng.choice(600, size=20, replace=False)] += 1
+    new[1] += 1
+
+    delta = model_delta(old, new, base_version=3)
+    assert delta.base_version == 3
+    assert delta.layers[0].nnz == 20 and delta.layers[1] is None
+
+    # Scattering the new values reproduces the new model exactly
+    loaded = old[0].copy()
+    np.put(loaded, delta.layers[0].indices, delta.layers[0].values)
+    np.testing.assert_array_equal(loaded, new[0])
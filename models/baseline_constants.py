@@ -51,6 +51,7 @@ BYTES_WRITTEN_BEFORE_KEY = 'bytes_written_before'
 BYTES_WRITTEN_AFTER_KEY = 'bytes_written_after'
 SPARSITY_KEY = 'weighted_sparsity'
 TRAIN_TIME_SECS_KEY = 'train_time_secs'
+DECODE_TIME_SECS_KEY = 'decode_time_secs'
 BYTES_READ_KEY = 'bytes_read'
 LOCAL_COMPUTATIONS_KEY = 'local_computations'
 NUM_ROUND_KEY = 'round_number'
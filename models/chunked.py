@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+
+"""Memory-bounded, blockwise versions of the compressors.
+
+The one-shot compressors allocate several full-size temporaries per call
+(``np.abs(x)``, ``np.zeros_like(x)``, sort orders and prefix sums), which puts
+their peak memory at several times the layer size. The functions here stream
+over the flattened update in blocks instead, so their working set stays under
+``max_bytes`` on top of the result itself. ``x`` can be a ``np.memmap``, in
+which case only the block being processed is ever read into memory.
+
+The results are the same as those of the one-shot versions: top-k keeps a
+running set of the k largest candidates that is merged with the top k of
+every block, STC takes its mean over the merged set, and sparse k-means runs
+the same Lloyd iterations on per-block cluster statistics, with the budget
+step and the warm-start splits computed by streaming passes as well.
+The one exception is a budget step that has to pick among equal xi2 values
+(typically on integer-valued data): ``np.argpartition`` leaves the choice
+among ties unspecified, while the streaming selection takes them in index
+order.
+"""
+
+from typing import Tuple
+import numpy as np
+
+from compressors import (
+    SparseUpdate,
+    _compute_dtype,
+)
+
+
+DEFAULT_MAX_BYTES = 64 * 2 ** 20
+
+# Generous upper bound on the bytes of temporaries per entry of a block
+_BYTES_PER_ENTRY = 64
+
+
+def block_size(max_bytes: int = DEFAULT_MAX_BYTES) -> int:
+    """Number of entries processed at once within max_bytes of working memory."""
+    return max(1, int(max_bytes) // _BYTES_PER_ENTRY)
+
+
+def iter_blocks(x: np.ndarray, size: int):
+    """Yield ``(start, block)`` over the flattened x, reading one block at a time."""
+    x = x.reshape(-1)
+    for start in range(0, x.size, size):
+        yield start, np.asarray(x[start:start + size])
+
+
+def _merge_top(idxs, values, k):
+    """Keep the k entries of largest magnitude out of a candidate set."""
+    if idxs.size <= k:
+        return idxs, values
+    keep = np.abs(values).argpartition(-k)[-k:]
+    return idxs[keep], values[keep]
+
+
+def topk_chunked(x: np.ndarray, k: int = 1, max_bytes: int = DEFAULT_MAX_BYTES) -> SparseUpdate:
+    """Blockwise ``TopKCompressor.compress_sparse``."""
+    assert 0 <= k <= x.size
+    idxs = np.zeros(0, dtype=np.intp)
+    values = np.zeros(0, dtype=x.dtype)
+    if k:
+        for start, block in iter_blocks(x, block_size(max_bytes)):
+            block_idxs, block_values = _merge_top(np.arange(block.size), block, k)
+            idxs, values = _merge_top(
+                np.concatenate((idxs, block_idxs + start)),
+                np.concatenate((values, block_values)),
+                k,
+            )
+    order = np.argsort(idxs)
+    return SparseUpdate(idxs[order], values[order], x.shape, x.dtype)
+
+
+def stc_chunked(x: np.ndarray, k: int = 1, max_bytes: int = DEFAULT_MAX_BYTES) -> SparseUpdate:
+    """Blockwise ``SparseTernaryCompressor.compress_sparse``."""
+    Cx = topk_chunked(x, k, max_bytes)
+    mean = np.sum(np.abs(Cx.values)) / np.count_nonzero(Cx.values)
+    return SparseUpdate.ternary(Cx.indices, np.sign(Cx.values), mean, x.shape, x.dtype)
+
+
+class _Segments:
+    """Nearest-centroid segments of theta, like ``compressors._segment_bounds``.
+
+    Points go to the centroid with the smaller float squared distance, and
+    duplicate centroids and exact ties resolve to the lowest centroid index,
+    as in the sort-based and dense engines.
+    """
+
+    def __init__(self, theta: np.ndarray):
+        order = np.argsort(theta, kind="stable")
+        c = theta[order]
+        unique = np.ones(c.size, dtype=bool)
+        unique[1:] = c[1:] != c[:-1]
+        self.ids, self.c = order[unique], c[unique]
+        self.mids = (self.c[:-1] + self.c[1:]) / 2
+
+    def labels(self, block: np.ndarray) -> np.ndarray:
+        p = np.searchsorted(self.mids, block, side="left")
+        # Points on or next to a rounded midpoint may be closer, in float, to
+        # the neighbouring centroid
+        for shift in (-1, 1):
+            q = np.clip(p + shift, 0, self.c.size - 1)
+            d_p = np.square(block - self.c[p])
+            d_q = np.square(block - self.c[q])
+            p = np.where((d_q < d_p) | ((d_q == d_p) & (self.ids[q] < self.ids[p])), q, p)
+        return self.ids[p]
+
+
+def _xi2(block: np.ndarray, labels: np.ndarray, theta: np.ndarray) -> np.ndarray:
+    return np.fmax(np.square(block) - np.square(block - theta[labels]), 0)
+
+
+def _nonzero_xi2_blocks(x, labels, theta, size):
+    """Yield ``(offset, nonzero xi2)`` per block, offset into the nonzero subset."""
+    offset = 0
+    for start, block in iter_blocks(x, size):
+        xi2 = _xi2(block, labels[start:start + block.size], theta)
+        xi2 = xi2[xi2 != 0]
+        yield offset, xi2
+        offset += xi2.size
+
+
+def _budget_positions(x, labels, theta, n_j, b, budget, size) -> np.ndarray:
+    """Streaming ``compressors._budget_reassignment``.
+
+    The ``num_exceeded + 1`` smallest nonzero xi2 are found with a radix
+    select over their bit patterns, 16 bits per pass, and their positions in
+    the nonzero subset are returned.
+    """
+    num_exceeded = int(np.ceil(n_j - (budget / b)))
+    m = num_exceeded + 1
+    dtype = _compute_dtype(x)
+    uint = np.dtype("u%d" % dtype.itemsize)
+    total = sum(xi2.size for _, xi2 in _nonzero_xi2_blocks(x, labels, theta, size))
+    assert m < total, "kth(=%d) out of bounds (%d)" % (m, total)
+
+    # Non-negative floats sort like their bit patterns, so select the m-th
+    # smallest bit pattern one 16-bit digit at a time, most significant first
+    prefix, rank = 0, m
+    for shift in range(8 * uint.itemsize - 16, -1, -16):
+        hist = np.zeros(2 ** 16, dtype=np.int64)
+        for _, xi2 in _nonzero_xi2_blocks(x, labels, theta, size):
+            bits = xi2.astype(dtype, copy=False).view(uint)
+            if shift + 16 < 8 * uint.itemsize:
+                bits = bits[(bits >> (shift + 16)) == prefix]
+            hist += np.bincount(((bits >> shift) & 0xFFFF).astype(np.intp), minlength=2 ** 16)
+        cum = np.cumsum(hist)
+        digit = int(np.searchsorted(cum, rank))
+        rank -= int(cum[digit - 1]) if digit else 0
+        prefix = (prefix << 16) | digit
+    kth = np.array(prefix, dtype=uint).view(dtype)
+
+    # Everything below the m-th smallest value, then as many ties as needed
+    positions = []
+    ties_needed = rank
+    for offset, xi2 in _nonzero_xi2_blocks(x, labels, theta, size):
+        xi2 = xi2.astype(dtype, copy=False)
+        positions.append(offset + np.flatnonzero(xi2 < kth))
+        if ties_needed:
+            ties = offset + np.flatnonzero(xi2 == kth)[:ties_needed]
+            positions.append(ties)
+            ties_needed -= ties.size
+    return np.concatenate(positions)
+
+
+def _compress_b_chunked(x, labels, b, budget, n_iters, tol, enforce_constraint, init, size):
+    """Blockwise ``compressors._compress_b_sorted``, labels are written to ``labels``."""
+    k = 2 ** b
+    n = x.size
+    dtype = _compute_dtype(x)
+    if init is None:
+        x_max = max(block.max() for _, block in iter_blocks(x, size))
+        theta = np.linspace(start=0, stop=x_max, num=k, dtype=dtype)
+    else:
+        theta = np.array(init, dtype=dtype)
+
+    for i in range(n_iters):
+        segments = _Segments(theta)
+        counts = np.zeros(k, dtype=np.intp)
+        sums = np.zeros(k, dtype=np.float64)
+        for start, block in iter_blocks(x, size):
+            l = segments.labels(block)
+            labels[start:start + block.size] = l
+            counts += np.bincount(l, minlength=k)
+            sums += np.bincount(l, weights=block, minlength=k)
+
+        n_j = n - counts[0]
+        if n_j > budget / b and enforce_constraint:
+            smallest_xi2 = _budget_positions(x, labels, theta, n_j, b, budget, size)
+            moved = smallest_xi2[labels[smallest_xi2] != 0]
+            moved_x = np.asarray(x.reshape(-1)[moved])
+            counts -= np.bincount(labels[moved], minlength=k)
+            sums -= np.bincount(labels[moved], weights=moved_x, minlength=k)
+            counts[0] += moved.size
+            sums[0] += moved_x.sum()
+            labels[smallest_xi2] = 0
+
+        theta_new = np.zeros_like(theta)
+        nonempty = counts > 0
+        theta_new[nonempty] = sums[nonempty] / counts[nonempty]
+        if enforce_constraint:
+            theta_new[0] = 0
+
+        converged = np.mean(np.square(theta_new - theta)) < tol
+        theta = theta_new
+        if converged:
+            break
+
+    return theta
+
+
+def _split_centroids_chunked(x, theta, enforce_constraint, size):
+    """Blockwise ``compressors._split_centroids``."""
+    k = theta.size
+    segments = _Segments(theta)
+    counts = np.zeros(2 * k, dtype=np.intp)
+    totals = np.zeros(2 * k, dtype=np.float64)
+    for _, block in iter_blocks(x, size):
+        l = segments.labels(block)
+        halves = 2 * l + (block >= theta[l])
+        counts += np.bincount(halves, minlength=2 * k)
+        totals += np.bincount(halves, weights=block, minlength=2 * k)
+
+    means = np.where(counts > 0, totals / np.maximum(counts, 1), np.repeat(theta, 2))
+    gains = totals * totals / np.maximum(counts, 1)
+    left, right = means[0::2], means[1::2]
+    if not enforce_constraint:
+        return np.concatenate((left, right))
+    zero_half = left[0] if gains[0] > gains[1] else right[0]
+    return np.concatenate(([0, zero_half], left[1:], right[1:]))
+
+
+def _squared_error(x, labels, theta, size) -> float:
+    return sum(
+        np.square(block - theta[labels[start:start + block.size]]).sum()
+        for start, block in iter_blocks(x, size)
+    )
+
+
+def sparse_kmeans_chunked(
+    gradient: np.ndarray,
+    budget: int = None,
+    enforce_constraint: bool = True,
+    min_bits: int = 1,
+    max_bits: int = 2,
+    max_bytes: int = DEFAULT_MAX_BYTES,
+) -> Tuple[SparseUpdate, float, int]:
+    """Blockwise ``compressors.sparse_kmeans(..., sparse=True)``.
+
+    Besides the blocks, only one byte of labels per entry is kept for the
+    current and the best bit-depth.
+    """
+    assert 1 <= min_bits <= max_bits <= 8, "bit-depths must lie in [1, 8]"
+    assert budget is not None and budget > 0, "budget must be an integer greater than 0"
+
+    x = gradient.reshape(-1)
+    size = block_size(max_bytes)
+    labels = np.zeros(x.size, dtype=np.uint8)
+    best_labels = np.zeros(x.size, dtype=np.uint8)
+    best = None
+    for b in range(min_bits, max_bits + 1):
+        init = None
+        if best is not None:
+            init = _split_centroids_chunked(x, best[2], enforce_constraint, size)
+        theta = _compress_b_chunked(
+            x, labels, b, budget, 10, 1e-8, enforce_constraint, init, size
+        )
+        error = _squared_error(x, labels, theta, size)
+        if best is None or error < best[0]:
+            best = (error, b, theta)
+            labels, best_labels = best_labels, labels
+        else:
+            break
+
+    _, b, centroids = best
+    centroids = centroids.astype(gradient.dtype)
+    compression_error = _squared_error(x, best_labels, centroids, size) / len(gradient)
+
+    if centroids[0] == 0:
+        indices = np.flatnonzero(best_labels)
+    else:
+        indices = np.arange(x.size)
+    compressed = SparseUpdate(
+        indices, best_labels[indices], gradient.shape, gradient.dtype, codebook=centroids
+    )
+    return compressed, compression_error, b
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+
+import numpy as np
+import pytest
+
+import chunked
+import compressors
+
+
+# A few hundred entries per block
+MAX_BYTES = 64 * 300
+
+
+@pytest.fixture
+def x():
+    return np.random.default_rng(0).standard_t(3, size=20000).astype(np.float32)
+
+
+def test_iter_blocks(x):
+    blocks = list(chunked.iter_blocks(x, 7000))
+    assert [start for start, _ in blocks] == [0, 7000, 14000]
+    np.testing.assert_array_equal(np.concatenate([block for _, block in blocks]), x)
+
+
+@pytest.mark.parametrize("k", [0, 1, 500, 20000])
+def test_topk_stc_chunked(x, k):
+    for one_shot, blockwise in [
+        (compressors.TopKCompressor.compress_sparse, chunked.topk_chunked),
+        (compressors.SparseTernaryCompressor.compress_sparse, chunked.stc_chunked),
+    ]:
+        if k == 0 and blockwise is chunked.stc_chunked:
+            continue
+        expected = one_shot(x, k)
+        actual = blockwise(x, k, MAX_BYTES)
+        np.testing.assert_array_equal(actual.indices, expected.indices)
+        np.testing.assert_array_equal(actual.values, expected.values)
+
+
+@pytest.mark.parametrize("enforce_constraint", [True, False])
+@pytest.mark.parametrize("budget_ratio", [0.1, 0.5, 2.0])
+def test_sparse_kmeans_chunked(x, enforce_constraint, budget_ratio):
+    budget = int(budget_ratio * x.size * x.itemsize)
+    expected, expected_error, expected_b = compressors.sparse_kmeans(
+        x, budget, enforce_constraint, max_bits=3, sparse=True)
+    actual, error, b = chunked.sparse_kmeans_chunked(
+        x, budget, enforce_constraint, max_bits=3, max_bytes=MAX_BYTES)
+    assert b == expected_b
+    np.testing.assert_array_equal(actual.indices, expected.indices)
+    np.testing.assert_array_equal(actual.values, expected.values)
+    np.testing.assert_allclose(actual.codebook, expected.codebook, rtol=1e-5, atol=1e-7)
+    assert np.isclose(error, expected_error, rtol=1e-4)
+
+
+def test_chunked_memmap(x, tmp_path):
+    path = tmp_path / "layer.npy"
+    np.save(path, x)
+    mapped = np.load(path, mmap_mode="r")
+    budget = int(0.5 * x.size * x.itemsize)
+    actual, _, _ = chunked.sparse_kmeans_chunked(mapped, budget, max_bytes=MAX_BYTES)
+    expected, _, _ = compressors.sparse_kmeans(x, budget, sparse=True)
+    np.testing.assert_array_equal(actual.values, expected.values)
+    np.testing.assert_array_equal(
+        chunked.topk_chunked(mapped, 100, MAX_BYTES).indices,
+        compressors.TopKCompressor.compress_sparse(x, 100).indices)
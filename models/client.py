@@ -6,16 +6,130 @@ import time
 import numpy as np
 from compressors import (
     sparse_ratio_metric,
-    TopKCompressor,
-    RandKCompressor,
-    SparseTernaryCompressor
+    TopKCompressor
 )
+from compression_policy import CompressionPolicy
+from encoding import encode
+
+
+# What the baseline experiments compress: layer 6 with STC at 90% space savings
+DEFAULT_POLICY = CompressionPolicy({6: ("stc", {"space_savings": 0.90})})
+
+
+def compress_update(update, policy=DEFAULT_POLICY, client_id=None, layer_names=None):
+    """Compresses the layers of a single client update picked by the policy.
+
+    The layers are compressed concurrently in the policy's thread pool.
+
+    Args:
+        update: set of weights
+        policy: CompressionPolicy with the layers to compress and how
+        client_id: id of the client, keys its error feedback residuals and
+            k-means warm-start centroids
+        layer_names: names of the weights, for policies over layer names
+    Return:
+        before_nonzeros: number of bytes in the compressed layers before compression
+        after_nonzeros: number of bytes the compressed layers take on the wire
+        weighted_sparsity: sparsity of the compressed layers weighted by their size
+        update: set of weights with the compressed layers replaced by their
+            encoded bytes
+        compress_time: compression time in seconds
+    """
+    ### Start Compression
+    compress_start = time.time()
+
+    update = list(update)
+    layers = policy.resolve(len(update), layer_names)
+
+    def compress_layer(i, layer_policy):
+        flattened = update[i].flatten()
+        compressed_flat = policy.compress(flattened, i, layer_policy, client_id)
+        # The layer travels as its encoded bytes, see Server._record_update
+        payload = encode(compressed_flat.reshape(update[i].shape))
+        return (TopKCompressor.getsizeof(flattened), len(payload), flattened.size,
+                sparse_ratio_metric(flattened), payload)
+
+    before_nonzeros = 0
+    after_nonzeros = 0
+    layer_lengths = []
+    layer_sparsities = []
+    for i, (before, after, flat_sz, sparsity, payload) in zip(
+            layers, policy.map(compress_layer, layers)):
+        before_nonzeros += before
+        after_nonzeros += after
+        layer_lengths.append(flat_sz)
+        layer_sparsities.append(sparsity)
+        update[i] = payload
+
+    weighted_sparsity = np.average(layer_sparsities, weights=layer_lengths) if layers else 0
+
+    compress_end = time.time()
+    ### End Compression
+
+    compress_time = int(round(compress_end - compress_start))
+
+    return before_nonzeros, after_nonzeros, weighted_sparsity, update, compress_time
+
+
+def compress_updates(updates, policy=DEFAULT_POLICY, client_ids=None, layer_names=None):
+    """Compresses the updates of a whole cohort at once.
+
+    Each layer picked by the policy is stacked into a (clients, d) matrix and
+    compressed with a single row-wise batched call, with the layers running
+    concurrently in the policy's thread pool. The result for every client is
+    the same as compress_update, and the compression time is split evenly
+    among the clients.
+
+    Return:
+        list with one compress_update tuple per update
+    """
+    compress_start = time.time()
+
+    updates = [list(update) for update in updates]
+    layers = policy.resolve(len(updates[0]), layer_names)
+
+    def compress_layer(i, layer_policy):
+        actual_shape = updates[0][i].shape
+        flattened = np.stack([update[i].flatten() for update in updates])
+        before = (1 * 8 + flattened.itemsize) * np.count_nonzero(flattened, axis=1)
+        sparsity = np.linalg.norm(flattened, ord=1, axis=1) / np.linalg.norm(flattened, ord=2, axis=1)
+        compressed_flat = policy.compress_batch(flattened, i, layer_policy, client_ids)
+        payloads = [encode(compressed_row.reshape(actual_shape))
+                    for compressed_row in compressed_flat]
+        return before, flattened.shape[1], sparsity, payloads
+
+    before_nonzeros = np.zeros(len(updates), dtype=int)
+    after_nonzeros = np.zeros(len(updates), dtype=int)
+    layer_lengths = []
+    layer_sparsities = []
+    for i, (before, flat_sz, sparsity, payloads) in zip(
+            layers, policy.map(compress_layer, layers)):
+        before_nonzeros += before
+        layer_lengths.append(flat_sz)
+        layer_sparsities.append(sparsity)
+        for j, (update, payload) in enumerate(zip(updates, payloads)):
+            after_nonzeros[j] += len(payload)
+            update[i] = payload
+
+    if layers:
+        weighted_sparsity = np.average(np.array(layer_sparsities), axis=0,
+                                       weights=layer_lengths)
+    else:
+        weighted_sparsity = np.zeros(len(updates))
+
+    compress_end = time.time()
+    compress_time = int(round((compress_end - compress_start) / len(updates)))
+
+    return [(int(before), int(after), sparsity, update, compress_time)
+            for before, after, sparsity, update
+            in zip(before_nonzeros, after_nonzeros, weighted_sparsity, updates)]
 
 
 class Client:
 
-    def __init__(self, client_id, group=None, train_data={'x' : [],'y' : []}, eval_data={'x' : [],'y' : []}, model=None):
+    def __init__(self, client_id, group=None, train_data={'x' : [],'y' : []}, eval_data={'x' : [],'y' : []}, model=None, policy=DEFAULT_POLICY):
         self._model = model
+        self.policy = policy
         self.id = client_id
         self.group = group
         self.train_data = train_data
@@ -35,6 +149,25 @@ class Client:
             update: set of weights
             update_size: number of bytes in update
         """
+        comp, num_train_samples, update, train_time = self.local_update(
+            num_epochs, batch_size, minibatch)
+        before_nonzeros, after_nonzeros, weighted_sparsity, update, compress_time = \
+            compress_update(update, self.policy, self.id, self.model.param_names)
+        train_time_secs = train_time + compress_time
+
+        return comp, num_train_samples, before_nonzeros, after_nonzeros, weighted_sparsity, update, train_time_secs
+
+    def local_update(self, num_epochs=1, batch_size=10, minibatch=None):
+        """Trains on self.model without compressing the resulting update.
+
+        Args:
+            See train.
+        Return:
+            comp: number of FLOPs executed in training process
+            num_samples: number of samples used in training
+            update: set of weights
+            train_time: training time in seconds
+        """
 
         # TODO: Swap this for a with statement and a timer
         train_start = time.time()
@@ -56,50 +189,7 @@ class Client:
         train_stop = time.time()
         train_time = int(round(train_stop - train_start))
 
-        before_nonzeros = 0
-        after_nonzeros = 0
-
-        ### Start Compression
-        compress_start = time.time()
-
-        layers_to_compress = [6]
-        layer_lengths = []
-        layer_sparsities = []
-        update = np.array(update)
-        for i in layers_to_compress:
-            actual_shape = update[i].shape
-            flattened = update[i].flatten()
-            before_nonzeros += TopKCompressor.getsizeof(flattened)
-            compressed_flat = flattened
-
-            # For calculating sparsity
-            flat_sz = flattened.size
-            space_savings = 0.90
-            k = int(np.ceil((1-space_savings) * flat_sz))
-
-            layer_lengths.append(flat_sz)
-            layer_sparsities.append(sparse_ratio_metric(flattened))
-
-            try:
-                compressed_flat = SparseTernaryCompressor.compress(x=flattened, k=k)
-            except:
-                print("ERROR")
-                print(flattened)
-                exit
-
-            after_nonzeros += RandKCompressor.getsizeof(compressed_flat)
-            update[i] = compressed_flat.reshape(actual_shape)
-
-            weighted_sparsity = np.average(layer_sparsities,
-                                           weights=layer_lengths)
-
-        compress_end = time.time()
-        ### End Compression
-
-        compress_time = int(round(compress_end - compress_start))
-        train_time_secs = train_time + compress_time
-
-        return comp, num_train_samples, before_nonzeros, after_nonzeros, weighted_sparsity, update, train_time_secs
+        return comp, num_train_samples, update, train_time
 
     def test(self, set_to_use='test'):
         """Tests self.model on self.test_data.
@@ -109,12 +199,18 @@ class Client:
         Return:
             dict of metrics returned by the model.
         """
+        return self.model.test(self.get_data(set_to_use))
+
+    def get_data(self, set_to_use='test'):
+        """Returns the client's data for the given set.
+
+        Args:
+            set_to_use. Should be in ['train', 'test', 'val'].
+        """
         assert set_to_use in ['train', 'test', 'val']
         if set_to_use == 'train':
-            data = self.train_data
-        elif set_to_use == 'test' or set_to_use == 'val':
-            data = self.eval_data
-        return self.model.test(data)
+            return self.train_data
+        return self.eval_data
 
     @property
     def num_test_samples(self):
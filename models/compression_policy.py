@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+
+"""Per-layer compression policies for client updates.
+
+A policy maps layers of a ``ClientModel`` to a compressor and its
+parameters. Layers are given either by their index in the list of trainable
+variables or by a glob pattern over the variable names (e.g. ``"*lstm*"``,
+``"dense/kernel:0"``). Policies are written as JSON files::
+
+    {"6": {"compressor": "stc", "space_savings": 0.9},
+     "*lstm*": {"compressor": "topk", "space_savings": 0.95}}
+
+or as a compact spec on the command line, with one ``;``-separated entry per
+layer::
+
+    6=stc,space_savings=0.9;*lstm*=topk,space_savings=0.95
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatchcase
+from typing import NamedTuple
+import inspect
+import json
+import os
+import numpy as np
+
+from compressors import (
+    SparseUpdate,
+    TopKCompressor,
+    SparseTernaryCompressor,
+    RandKCompressor,
+    CentroidCache,
+    ErrorFeedback,
+    sparse_kmeans,
+    sparse_kmeans_batch,
+)
+from chunked import topk_chunked, stc_chunked, sparse_kmeans_chunked
+
+
+def _k(x: np.ndarray, space_savings: float) -> int:
+    """Number of entries kept out of the last axis of x."""
+    return int(np.ceil((1 - space_savings) * x.shape[-1]))
+
+
+def _kmeans_budget(x: np.ndarray, budget_ratio: float) -> int:
+    # Same budget as the results/exp83 kmeans_* runs
+    return int(np.floor(budget_ratio * x.shape[-1] * x.itemsize))
+
+
+def _baseline(x, **_):
+    return SparseUpdate.from_dense(x)
+
+
+def _topk(x, space_savings=0.90, approx=False, max_bytes=None, **kwargs):
+    if max_bytes is not None:
+        return topk_chunked(x, _k(x, space_savings), max_bytes)
+    if approx:
+        compressed, _ = TopKCompressor.compress_approx(x, k=_k(x, space_savings), **kwargs)
+        return compressed
+    return TopKCompressor.compress_sparse(x, k=_k(x, space_savings))
+
+
+def _topk_batch(X, space_savings=0.90, approx=False, max_bytes=None, **kwargs):
+    if approx or max_bytes is not None:
+        return [_topk(x, space_savings, approx, max_bytes, **kwargs) for x in X]
+    return TopKCompressor.compress_batch(X, k=_k(X, space_savings))
+
+
+def _stc(x, space_savings=0.90, max_bytes=None):
+    if max_bytes is not None:
+        return stc_chunked(x, _k(x, space_savings), max_bytes)
+    return SparseTernaryCompressor.compress_sparse(x, k=_k(x, space_savings))
+
+
+def _stc_batch(X, space_savings=0.90, max_bytes=None):
+    if max_bytes is not None:
+        return [_stc(x, space_savings, max_bytes) for x in X]
+    SX = SparseTernaryCompressor.compress_batch(X, k=_k(X, space_savings))
+    # Same ternary codebook form as compress_sparse
+    return [SparseUpdate.ternary(np.arange(sx.size), np.sign(sx), np.abs(sx).max(initial=0),
+                                 sx.shape, sx.dtype) for sx in SX]
+
+
+def _randk(x, space_savings=0.90, seeded=False, block_size=1):
+    if seeded:
+        # Only the seed travels, the server regenerates the indices from it
+        seed = int(np.random.default_rng().integers(2 ** 63))
+        return RandKCompressor.compress_seeded(x, _k(x, space_savings), seed, block_size)
+    return RandKCompressor.compress_sparse(x, k=_k(x, space_savings))
+
+
+def _randk_batch(X, space_savings=0.90, seeded=False, block_size=1):
+    if seeded:
+        return [_randk(x, space_savings, seeded, block_size) for x in X]
+    return RandKCompressor.compress_batch(X, k=_k(X, space_savings))
+
+
+def _kmeans(x, budget_ratio=0.95, max_bytes=None, **kwargs):
+    if max_bytes is not None:
+        compressed, _, _ = sparse_kmeans_chunked(
+            x, _kmeans_budget(x, budget_ratio), max_bytes=max_bytes, **kwargs)
+        return compressed
+    compressed, _, _ = sparse_kmeans(x, _kmeans_budget(x, budget_ratio), sparse=True, **kwargs)
+    return compressed
+
+
+_KMEANS_BATCH_PARAMS = {"enforce_constraint", "min_bits", "max_bits", "scale"}
+
+
+def _kmeans_batch(X, budget_ratio=0.95, cache=None, cache_keys=None, **kwargs):
+    if set(kwargs) - _KMEANS_BATCH_PARAMS:
+        # Exact, approximate and chunked fits are only done row by row
+        if cache is None:
+            return [_kmeans(x, budget_ratio, **kwargs) for x in X]
+        return [_kmeans(x, budget_ratio, cache=cache, cache_key=key, **kwargs)
+                for x, key in zip(X, cache_keys)]
+    CX, _, _ = sparse_kmeans_batch(X, _kmeans_budget(X, budget_ratio), sparse=True,
+                                   cache=cache, cache_keys=cache_keys, **kwargs)
+    return CX
+
+
+def _arguments(fn, *filled_in) -> set:
+    """Parameters of fn, without the ones the compressor fills in itself."""
+    return set(inspect.signature(fn).parameters) - {"x", *filled_in}
+
+
+def _topk_params(params) -> set:
+    accepted = _arguments(_topk) - {"kwargs"}
+    if params.get("approx") and params.get("max_bytes") is None:
+        accepted |= _arguments(TopKCompressor.compress_approx, "k")
+    return accepted
+
+
+def _kmeans_params(params) -> set:
+    accepted = _arguments(_kmeans) - {"kwargs"}
+    if params.get("max_bytes") is not None:
+        return accepted | _arguments(sparse_kmeans_chunked, "gradient", "budget")
+    return accepted | _arguments(sparse_kmeans, "gradient", "budget", "sparse", "cache", "cache_key")
+
+
+class _Compressor(NamedTuple):
+    compress: callable
+    # Row-wise version for a stacked cohort, None to compress row by row
+    compress_batch: callable = None
+    # Parameters a layer policy may set, given its params
+    accepts: callable = lambda params: set()
+
+
+COMPRESSORS = {
+    "baseline": _Compressor(_baseline),
+    "topk": _Compressor(_topk, _topk_batch, _topk_params),
+    "stc": _Compressor(_stc, _stc_batch, lambda params: _arguments(_stc)),
+    "randk": _Compressor(_randk, _randk_batch, lambda params: _arguments(_randk)),
+    "kmeans": _Compressor(_kmeans, _kmeans_batch, _kmeans_params),
+}
+
+
+class LayerPolicy(NamedTuple):
+    compressor: str
+    params: dict
+
+
+def _parse_value(value: str):
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+def _layer_key(key):
+    return int(key) if isinstance(key, str) and key.isdigit() else key
+
+
+class CompressionPolicy:
+    """Which layers of an update are compressed, and how.
+
+    Parameters
+    ----------
+    layers : dict
+        Maps a layer index or glob pattern over layer names to a LayerPolicy,
+        or to a ``(compressor, params)`` pair. If several entries match a
+        layer, the first one wins.
+    max_workers : int
+        Threads compressing the layers of an update concurrently, defaults to
+        the ThreadPoolExecutor default. NumPy's partition and sort release the
+        GIL, so the layers really run in parallel.
+    cache : CentroidCache
+        Warm-start cache for ``kmeans`` layers, keyed by client and layer
+    feedback : ErrorFeedback
+        Adds each client's residual back into a layer before it is compressed
+    """
+
+    def __init__(
+        self,
+        layers: dict,
+        max_workers: int = None,
+        cache: CentroidCache = None,
+        feedback: ErrorFeedback = None,
+    ):
+        self.layers = {}
+        for key, policy in layers.items():
+            compressor, params = policy
+            assert compressor in COMPRESSORS, "unknown compressor %r" % compressor
+            unknown = set(params) - COMPRESSORS[compressor].accepts(params)
+            assert not unknown, "unknown parameters %s for %s" % (sorted(unknown), compressor)
+            self.layers[_layer_key(key)] = LayerPolicy(compressor, dict(params))
+        self.max_workers = max_workers
+        self.cache = cache
+        self.feedback = feedback
+        self._executor = None
+
+    @classmethod
+    def from_spec(cls, spec: str, **kwargs) -> "CompressionPolicy":
+        """Parse a ``layer=compressor,param=value;...`` spec or a JSON file path."""
+        if os.path.isfile(spec):
+            with open(spec) as f:
+                entries = json.load(f)
+            layers = {}
+            for key, entry in entries.items():
+                entry = dict(entry)
+                layers[key] = (entry.pop("compressor"), entry)
+            return cls(layers, **kwargs)
+
+        layers = {}
+        for entry in filter(None, (e.strip() for e in spec.split(";"))):
+            key, _, rest = entry.partition("=")
+            compressor, *params = rest.split(",")
+            params = dict(param.split("=", 1) for param in params)
+            layers[key.strip()] = (
+                compressor.strip(),
+                {name.strip(): _parse_value(value) for name, value in params.items()},
+            )
+        return cls(layers, **kwargs)
+
+    def resolve(self, num_layers: int, layer_names=None) -> dict:
+        """Map every compressed layer index to its LayerPolicy."""
+        resolved = {}
+        for i in range(num_layers):
+            name = layer_names[i] if layer_names is not None else None
+            for key, policy in self.layers.items():
+                if key == i or (name is not None and isinstance(key, str) and fnmatchcase(name, key)):
+                    resolved[i] = policy
+                    break
+        return resolved
+
+    def _warm_starts(self, policy: LayerPolicy) -> bool:
+        # The chunked k-means engine is not warm-started
+        return (policy.compressor == "kmeans" and self.cache is not None
+                and "max_bytes" not in policy.params)
+
+    def compress(self, x: np.ndarray, layer: int, policy: LayerPolicy, client_id=None):
+        """Compress one flattened layer of a client's update."""
+        params = policy.params
+        if self._warm_starts(policy):
+            params = dict(params, cache=self.cache, cache_key=(client_id, layer))
+        if self.feedback is not None:
+            x = self.feedback.correct(x, client_id, layer)
+        compressed = COMPRESSORS[policy.compressor].compress(x, **params)
+        if self.feedback is not None:
+            self.feedback.record(x, compressed, client_id, layer)
+        return compressed
+
+    def compress_batch(self, X: np.ndarray, layer: int, policy: LayerPolicy, client_ids=None):
+        """Compress one flattened layer of a whole cohort, one client per row."""
+        if client_ids is None:
+            client_ids = [None] * len(X)
+        compress_batch = COMPRESSORS[policy.compressor].compress_batch
+        params = policy.params
+        if self._warm_starts(policy):
+            params = dict(params, cache=self.cache, cache_keys=[(c, layer) for c in client_ids])
+            if len(set(client_ids)) < len(client_ids):
+                # Clients sharing a key warm-start each other, one after another
+                compress_batch = None
+        if compress_batch is None:
+            return [self.compress(x, layer, policy, c) for x, c in zip(X, client_ids)]
+        if self.feedback is not None:
+            X = np.stack([self.feedback.correct(x, c, layer) for x, c in zip(X, client_ids)])
+        CX = compress_batch(X, **params)
+        if self.feedback is not None:
+            for x, compressed, c in zip(X, CX, client_ids):
+                self.feedback.record(x, compressed, c, layer)
+        return CX
+
+    def map(self, fn, layers):
+        """``[fn(i, policy) for i, policy in layers.items()]``, run in the thread pool."""
+        if len(layers) <= 1 or self.max_workers == 1:
+            return [fn(i, policy) for i, policy in layers.items()]
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.max_workers)
+        futures = [self._executor.submit(fn, i, policy) for i, policy in layers.items()]
+        return [future.result() for future in futures]
+
+    def __repr__(self) -> str:
+        return "CompressionPolicy(%r)" % self.layers
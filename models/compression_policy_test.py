@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+import json
+import numpy as np
+import pytest
+
+import client
+import compressors
+import encoding
+from compression_policy import CompressionPolicy, LayerPolicy
+
+
+LAYER_NAMES = ["conv1/kernel:0", "conv1/bias:0", "lstm/kernel:0", "lstm/bias:0", "dense/kernel:0"]
+
+
+@pytest.fixture
+def updates():
+    rng = np.random.default_rng(0)
+    shapes = [(5, 5, 8), (8,), (40, 64), (64,), (64, 10)]
+    return [[rng.normal(size=shape).astype(np.float32) for shape in shapes] for _ in range(3)]
+
+
+def test_from_spec(tmp_path):
+    policy = CompressionPolicy.from_spec("4=stc,space_savings=0.9; lstm/*=kmeans,max_bits=3")
+    assert policy.layers == {
+        4: LayerPolicy("stc", {"space_savings": 0.9}),
+        "lstm/*": LayerPolicy("kmeans", {"max_bits": 3}),
+    }
+
+    path = tmp_path / "policy.json"
+    path.write_text(json.dumps({"4": {"compressor": "stc", "space_savings": 0.9},
+                                "lstm/*": {"compressor": "kmeans", "max_bits": 3}}))
+    assert CompressionPolicy.from_spec(str(path)).layers == policy.layers
+
+    with pytest.raises(AssertionError):
+        CompressionPolicy.from_spec("4=zip")
+    # Misspelled parameters and ones the chosen engine does not take
+    for spec in ["0=stc,space_saving=0.9", "0=kmeans,max_bytes=1000000,scale=true",
+                 "0=topk,tol=0.1", "0=baseline,k=3"]:
+        with pytest.raises(AssertionError):
+            CompressionPolicy.from_spec(spec)
+    CompressionPolicy.from_spec("0=topk,approx=true,tol=0.1;1=kmeans,scale=true,max_bits=3")
+
+
+def test_resolve():
+    policy = CompressionPolicy.from_spec("lstm/*=topk;4=stc;*kernel*=randk")
+    resolved = policy.resolve(len(LAYER_NAMES), LAYER_NAMES)
+    assert {i: p.compressor for i, p in resolved.items()} == {
+        0: "randk", 2: "topk", 3: "topk", 4: "stc"}
+    # Without names only indices match
+    assert list(policy.resolve(len(LAYER_NAMES))) == [4]
+
+
+def test_compress_update(updates):
+    policy = CompressionPolicy.from_spec("0=topk,space_savings=0.5;2=stc;4=kmeans")
+    before, after, sparsity, update, _ = client.compress_update(updates[0], policy, "c0", LAYER_NAMES)
+    assert after < before
+    assert isinstance(update[1], np.ndarray)
+    assert all(isinstance(update[i], bytes) for i in [0, 2, 4])
+
+    # Parallel and serial compression give the same update
+    serial = CompressionPolicy(policy.layers, max_workers=1)
+    assert client.compress_update(updates[0], serial, "c0", LAYER_NAMES)[:4] == (before, after, sparsity, update)
+
+
+def test_compress_updates_matches_single(updates):
+    policy = CompressionPolicy.from_spec("0=topk,space_savings=0.5;lstm/kernel:0=stc;4=kmeans,scale=true")
+    batched = client.compress_updates(updates, policy, ["c0", "c1", "c2"], LAYER_NAMES)
+    for update, result in zip(updates, batched):
+        single = client.compress_update(update, policy, None, LAYER_NAMES)
+        assert result[:2] == single[:2]
+        for i in [0, 2, 4]:
+            # STC means are summed in a different order in the batch
+            np.testing.assert_allclose(encoding.decode(result[3][i]).toarray(),
+                                       encoding.decode(single[3][i]).toarray(), rtol=1e-6)
+
+
+def test_policy_error_feedback(updates):
+    feedback = compressors.ErrorFeedback()
+    policy = CompressionPolicy.from_spec("2=topk,space_savings=0.9", feedback=feedback)
+    client.compress_update(updates[0], policy, "c0")
+    client.compress_update(updates[1], policy, "c0")
+    assert feedback.store.get("c0", 2).shape == (40 * 64,)
+
+
+def test_seeded_randk(updates):
+    seeded = CompressionPolicy.from_spec("2=randk,seeded=true,block_size=8")
+    plain = CompressionPolicy.from_spec("2=randk")
+    _, seeded_bytes, _, update, _ = client.compress_update(updates[0], seeded)
+    _, plain_bytes, _, _, _ = client.compress_update(updates[0], plain)
+    assert seeded_bytes < plain_bytes
+    decoded = encoding.decode(update[2])
+    np.testing.assert_array_equal(decoded.data, updates[0][2].ravel()[decoded.indices])
+
+
+def test_chunked_policy(updates):
+    one_shot = CompressionPolicy.from_spec("2=topk;4=kmeans")
+    chunked = CompressionPolicy.from_spec("2=topk,max_bytes=4096;4=kmeans,max_bytes=4096")
+    assert client.compress_update(updates[0], chunked)[1] == client.compress_update(updates[0], one_shot)[1]
+
+
+@pytest.mark.parametrize("spec", ["4=kmeans,max_bits=3", "4=kmeans,approx=sketch,approx_size=64"])
+def test_compress_updates_warm_starts_like_single(updates, spec):
+    client_ids = ["c0", "c1", "c2"]
+    rng = np.random.default_rng(1)
+    rounds = [updates, [[v + 0.1 * rng.normal(size=v.shape).astype(v.dtype) for v in update]
+                        for update in updates]]
+    single = CompressionPolicy.from_spec(spec, cache=compressors.CentroidCache())
+    batched = CompressionPolicy.from_spec(spec, cache=compressors.CentroidCache())
+    for cohort in rounds:
+        results = client.compress_updates(cohort, batched, client_ids)
+        for update, c, result in zip(cohort, client_ids, results):
+            expected = client.compress_update(update, single, c)
+            assert result[:2] == expected[:2]
+            np.testing.assert_allclose(encoding.decode(result[3][4]).toarray(),
+                                       encoding.decode(expected[3][4]).toarray())
+    assert batched.cache.hits == single.cache.hits > 0
+    for c in client_ids:
+        np.testing.assert_allclose(batched.cache.get(c, 4, 1), single.cache.get(c, 4, 1))
@@ -2,10 +2,39 @@
 
 """Sparsified k-means for client-adaptive federated learning."""
 
-from typing import Union, Callable
+from collections import OrderedDict
+from typing import Union, Callable, Hashable, NamedTuple, Tuple
+import os
+import sys
+import tempfile
+import threading
 import numpy as np
 
 
+# Dtype the k-means engines compute centroids and distances in. float32 keeps
+# the float32 weights of the models in their native dtype end to end, float64
+# is the reference precision for validation. Data is never computed in a
+# narrower dtype than its own.
+PRECISION = np.dtype(np.float32)
+
+
+def set_precision(dtype):
+    """Set the compute precision of the compressors, float32 or float64."""
+    global PRECISION
+    dtype = np.dtype(dtype)
+    assert dtype in (np.float32, np.float64), "precision must be float32 or float64"
+    PRECISION = dtype
+
+
+def get_precision() -> np.dtype:
+    """Return the compute precision of the compressors."""
+    return PRECISION
+
+
+def _compute_dtype(x: np.ndarray) -> np.dtype:
+    return np.result_type(x.dtype, PRECISION)
+
+
 def mse(A: np.ndarray, B: np.ndarray) -> np.ndarray:
     """Calculate MSE between two ndarrays A and B."""
     return (np.linalg.norm(A - B) ** 2) / len(A)
@@ -15,6 +44,138 @@ def sparse_ratio_metric(x: np.ndarray):
     return np.linalg.norm(x, ord=1) / np.linalg.norm(x, ord=2)
 
 
+class SparseUpdate:
+    """Sparse COO representation of a compressed update.
+
+    Only the retained entries are stored: their flat (C-order) ``indices``
+    into an array of the given ``shape`` and their ``values``. When a
+    ``codebook`` is given, ``values`` holds integer labels into it instead
+    (e.g. k-means centroids), and the actual values are ``codebook[values]``.
+    The dense array is only built on demand with ``toarray``, which numpy
+    functions also call implicitly through ``__array__``.
+
+    Parameters
+    ----------
+    indices : np.ndarray
+        Flat indices of the retained entries
+    values : np.ndarray
+        Values of the retained entries, or labels into ``codebook``
+    shape : tuple
+        Shape of the dense update
+    dtype : np.dtype
+        Dtype of the dense update, defaults to the dtype of the values
+    codebook : np.ndarray
+        Optional table of values that ``values`` indexes into
+    index_seed : tuple
+        Optional ``(seed, block_size)`` the indices were drawn from with
+        ``RandKCompressor.seeded_indices``. The indices then never need to be
+        sent, the receiver regenerates them from the seed.
+    """
+
+    __slots__ = ("indices", "values", "shape", "dtype", "codebook", "index_seed")
+
+    def __init__(self, indices, values, shape, dtype=None, codebook=None, index_seed=None):
+        self.indices = np.asarray(indices)
+        self.index_seed = index_seed
+        self.values = np.asarray(values)
+        self.shape = tuple(shape) if np.ndim(shape) else (int(shape),)
+        self.codebook = None if codebook is None else np.asarray(codebook)
+        if dtype is None:
+            dtype = (self.values if codebook is None else self.codebook).dtype
+        self.dtype = np.dtype(dtype)
+
+    @classmethod
+    def from_dense(cls, x: np.ndarray) -> "SparseUpdate":
+        """Build a SparseUpdate holding the nonzero entries of x."""
+        indices = np.flatnonzero(x)
+        return cls(indices, x.ravel()[indices], x.shape, x.dtype)
+
+    @classmethod
+    def ternary(cls, indices, signs, mean, shape, dtype) -> "SparseUpdate":
+        """Build the ternary update ``mean * signs`` at the given indices.
+
+        It is stored as 1-bit labels into the codebook ``[-mean, mean]``, and
+        entries with a zero sign are dropped.
+        """
+        keep = signs != 0
+        return cls(indices[keep], (signs[keep] > 0).astype(np.uint8), shape, dtype,
+                   codebook=np.array([-mean, mean], dtype=dtype))
+
+    @property
+    def size(self) -> int:
+        """Number of entries of the dense update."""
+        return int(np.prod(self.shape))
+
+    @property
+    def nnz(self) -> int:
+        """Number of stored entries."""
+        return self.indices.size
+
+    @property
+    def data(self) -> np.ndarray:
+        """Values of the stored entries, looked up in the codebook if any."""
+        if self.codebook is None:
+            return self.values
+        return self.codebook[self.values]
+
+    @property
+    def nbytes(self) -> int:
+        """Bytes taken by the stored indices, values and codebook.
+
+        Seeded indices only cost their 8-byte seed and 4-byte block size.
+        """
+        nbytes = self.values.nbytes
+        nbytes += self.indices.nbytes if self.index_seed is None else 12
+        if self.codebook is not None:
+            nbytes += self.codebook.nbytes
+        return nbytes
+
+    def __sizeof__(self) -> int:
+        return object.__sizeof__(self) + self.nbytes
+
+    def __repr__(self) -> str:
+        return "SparseUpdate(shape=%s, dtype=%s, nnz=%d, codebook=%s)" % (
+            self.shape, self.dtype, self.nnz,
+            None if self.codebook is None else self.codebook.size,
+        )
+
+    def reshape(self, shape) -> "SparseUpdate":
+        """Return the same entries viewed as an update of another shape."""
+        assert int(np.prod(shape)) == self.size, "cannot change the number of entries"
+        return SparseUpdate(
+            self.indices, self.values, shape, self.dtype, self.codebook, self.index_seed
+        )
+
+    def toarray(self) -> np.ndarray:
+        """Densify the update."""
+        x = np.zeros(self.size, dtype=self.dtype)
+        x[self.indices] = self.data
+        return x.reshape(self.shape)
+
+    def __array__(self, dtype=None, copy=None) -> np.ndarray:
+        x = self.toarray()
+        return x if dtype is None else x.astype(dtype, copy=False)
+
+    def add_to(self, out: np.ndarray, weight: float = 1) -> np.ndarray:
+        """Add ``weight`` times this update into the dense array ``out`` in place."""
+        assert out.size == self.size, "shape mismatch"
+        flat = out.reshape(-1)
+        assert np.shares_memory(flat, out), "out must be contiguous"
+        if self.codebook is None:
+            flat[self.indices] += weight * self.values.astype(out.dtype, copy=False)
+            return out
+        # Scale the few codebook entries instead of every stored value, and
+        # skip the entries whose label points at a zero centroid
+        table = weight * self.codebook.astype(out.dtype)
+        indices, labels = self.indices, self.values
+        zero = np.flatnonzero(table == 0)
+        if zero.size:
+            keep = ~np.isin(labels, zero)
+            indices, labels = indices[keep], labels[keep]
+        flat[indices] += table[labels]
+        return out
+
+
 class Compressor:
 
     """Base class for a compressor."""
@@ -22,11 +183,15 @@ class Compressor:
         """Compress the vector."""
         pass
 
+    def compress_sparse(g: np.ndarray) -> SparseUpdate:
+        """Compress the vector into a SparseUpdate, without a dense copy."""
+        pass
+
     def getsizeof(g: np.ndarray) -> int:
         """Return the size of the vector in bytes."""
-        # If we implemented a custom type for vectors, we could simply
-        # implement the object's __sizeof__ method and sys.getsizeof would just
-        # work. Alas.
+        # For a SparseUpdate this is exact: sys.getsizeof works on it, and
+        # its nbytes is what the compressed vector takes without the Python
+        # object overhead. Dense arrays are still estimated as sparse COO.
         pass
 
 
@@ -57,7 +222,7 @@ class BaselineCompressor(Compressor):
 
         Parameters
         ----------
-        x : np.ndarray
+        x : np.ndarray or SparseUpdate
             Numpy array "compressed" with baseline "compressor"
 
         Returns
@@ -65,6 +230,8 @@ class BaselineCompressor(Compressor):
         int
             Size of the numpy array in bytes
         """
+        if isinstance(x, SparseUpdate):
+            return x.nbytes
         return (1 * 8 + x.itemsize) * np.count_nonzero(x)
 
 
@@ -102,6 +269,134 @@ class TopKCompressor(Compressor):
         Cx[topk_idxs] = x[topk_idxs]
         return Cx
 
+    @staticmethod
+    def compress_sparse(x: np.ndarray, k: int = 1) -> SparseUpdate:
+        """Compress a numpy array using Top-k compression into a SparseUpdate
+
+        Parameters
+        ----------
+        x : np.ndarray
+            Numpy array compressed using Top-k compression
+        k : int
+            Number of entries to retain
+
+        Raises
+        ------
+        AssertionError
+            Number of entries to retain is less than zero or greater than size
+            of numpy array
+
+        Returns
+        -------
+        SparseUpdate
+            The k retained entries, sorted by index
+        """
+        assert 0 <= k <= len(x)
+        if k == len(x):
+            topk_idxs = np.arange(len(x))
+        else:
+            topk_idxs = np.sort(np.abs(x).argpartition(-k)[-k:]) if k else np.arange(0)
+        return SparseUpdate(topk_idxs, x[topk_idxs], x.shape, x.dtype)
+
+    @staticmethod
+    def compress_approx(
+        x: np.ndarray, k: int = 1, sample_size: int = 65536, tol: float = 0.05, rng = None
+    ) -> Tuple[SparseUpdate, float]:
+        """Approximately compress a numpy array using Top-k compression
+
+        Instead of partitioning ``np.abs(x)``, the magnitude threshold of the
+        top k entries is estimated from ``sample_size`` randomly drawn entries
+        and the entries at or above it are picked with one comparison pass,
+        without a copy of x. If the count is off by more than ``tol * k``, one
+        extra pass corrects the threshold, trimming any surplus back to k.
+
+        Parameters
+        ----------
+        x : np.ndarray
+            Numpy array compressed using Top-k compression
+        k : int
+            Number of entries to retain
+        sample_size : int
+            Number of entries the threshold is estimated from
+        tol : float
+            Relative deviation from k accepted without the extra pass
+        rng : np.random.Generator
+            Random number generator used for sampling
+
+        Raises
+        ------
+        AssertionError
+            Number of entries to retain is less than zero or greater than size
+            of numpy array
+
+        Returns
+        -------
+        SparseUpdate
+            The retained entries, sorted by index
+        float
+            Relative deviation of the number of retained entries from k
+        """
+        assert 0 <= k <= len(x)
+        n = x.size
+        if k == 0 or k == n or sample_size >= n:
+            return TopKCompressor.compress_sparse(x, k), 0.0
+        if rng is None:
+            rng = np.random.default_rng()
+
+        sample = np.abs(x[rng.integers(0, n, size=sample_size)])
+        sample.sort()
+        j = min(int(round(sample_size * (1 - k / n))), sample_size - 1)
+        threshold = sample[j]
+        idxs = np.flatnonzero((x >= threshold) | (x <= -threshold))
+
+        if abs(idxs.size - k) > tol * k:
+            if idxs.size < k:
+                # Aim for the missing entries among those below the threshold
+                missing = (k - idxs.size) / (n - idxs.size)
+                below = sample[: np.searchsorted(sample, threshold)]
+                if below.size:
+                    j = min(int(round(below.size * (1 - missing))), below.size - 1)
+                    threshold = below[j]
+                    idxs = np.flatnonzero((x >= threshold) | (x <= -threshold))
+            if idxs.size > k:
+                keep = np.abs(x[idxs]).argpartition(-k)[-k:]
+                idxs = np.sort(idxs[keep])
+
+        deviation = (idxs.size - k) / k
+        return SparseUpdate(idxs, x[idxs], x.shape, x.dtype), deviation
+
+    @staticmethod
+    def compress_batch(X: np.ndarray, k: int = 1) -> np.ndarray:
+        """Compress every row of a 2-D numpy array using Top-k compression
+
+        Parameters
+        ----------
+        X : np.ndarray
+            Numpy array of shape (clients, d), one flattened update per row
+        k : int
+            Number of entries to retain in every row
+
+        Raises
+        ------
+        AssertionError
+            Number of entries to retain is less than zero or greater than the
+            length of a row
+
+        Returns
+        -------
+        np.ndarray
+            Compressed numpy array, row i equals ``compress(X[i], k)``
+        """
+        assert X.ndim == 2 and 0 <= k <= X.shape[1]
+        if k == 0:
+            return np.zeros_like(X)
+        if k == X.shape[1]:
+            return X
+        topk_idxs = np.abs(X).argpartition(-k, axis=1)[:, -k:]
+        CX = np.zeros_like(X)
+        np.put_along_axis(CX, topk_idxs, np.take_along_axis(X, topk_idxs, axis=1), axis=1)
+        return CX
+
     @staticmethod
     def getsizeof(x: np.ndarray) -> int:
         """Return the size of the numpy array (treated as sparse COO) in bytes
@@ -111,7 +406,7 @@ class TopKCompressor(Compressor):
 
         Parameters
         ----------
-        x : np.ndarray
+        x : np.ndarray or SparseUpdate
             Numpy array compressed using Top-k compression
 
         Returns
@@ -119,6 +414,8 @@ class TopKCompressor(Compressor):
         int
             Size of the numpy array in bytes
         """
+        if isinstance(x, SparseUpdate):
+            return x.nbytes
         return (1 * 8 + x.itemsize) * np.count_nonzero(x)
 
 
@@ -154,6 +451,61 @@ class SparseTernaryCompressor(Compressor):
         Cx = TopKCompressor.compress(x=x, k=k)
         return np.sign(Cx) * (np.sum(np.abs(Cx)) / np.count_nonzero(Cx))
 
+    @staticmethod
+    def compress_sparse(x: np.ndarray, k: int = 1) -> SparseUpdate:
+        """Compress a numpy array using Sparse Ternary Compression into a SparseUpdate
+
+        Parameters
+        ----------
+        x : np.ndarray
+            Numpy array compressed using Sparse Ternary Compression
+        k : int
+            Number of entries to retain
+
+        Raises
+        ------
+        AssertionError
+            Number of entries to retain is less than zero or greater than size
+            of numpy array
+
+        Returns
+        -------
+        SparseUpdate
+            The nonzero entries out of the k retained ones, sorted by index,
+            as labels into the codebook ``[-mean, mean]``
+        """
+        Cx = TopKCompressor.compress_sparse(x=x, k=k)
+        mean = np.sum(np.abs(Cx.values)) / np.count_nonzero(Cx.values)
+        return SparseUpdate.ternary(Cx.indices, np.sign(Cx.values), mean, x.shape, x.dtype)
+
+    @staticmethod
+    def compress_batch(X: np.ndarray, k: int = 1) -> np.ndarray:
+        """Compress every row of a 2-D numpy array using Sparse Ternary Compression
+
+        Parameters
+        ----------
+        X : np.ndarray
+            Numpy array of shape (clients, d), one flattened update per row
+        k : int
+            Number of entries to retain in every row
+
+        Raises
+        ------
+        AssertionError
+            Number of entries to retain is less than zero or greater than the
+            length of a row
+
+        Returns
+        -------
+        np.ndarray
+            Compressed numpy array, row i equals ``compress(X[i], k)``
+        """
+        CX = TopKCompressor.compress_batch(X=X, k=k)
+        means = np.sum(np.abs(CX), axis=1) / np.count_nonzero(CX, axis=1)
+        # Keep float32 rows in float32, like the scalar mean in compress
+        means = means.astype(np.result_type(CX.dtype, np.float32))
+        return np.sign(CX) * means[:, np.newaxis]
+
     @staticmethod
     def getsizeof(x: np.ndarray) -> int:
         """Return the size of the numpy array (treated as sparse COO) in bytes
@@ -163,7 +515,7 @@ class SparseTernaryCompressor(Compressor):
 
         Parameters
         ----------
-        x : np.ndarray
+        x : np.ndarray or SparseUpdate
             Numpy array compressed using Top-k compression
 
         Returns
@@ -171,6 +523,8 @@ class SparseTernaryCompressor(Compressor):
         int
             Size of the numpy array in bytes
         """
+        if isinstance(x, SparseUpdate):
+            return x.nbytes
         return (1 * 8 + x.itemsize) * np.count_nonzero(x)
 
 
@@ -215,6 +569,145 @@ class RandKCompressor(Compressor):
         Cx[res] = x[res]
         return Cx
 
+    @staticmethod
+    def compress_sparse(x: np.ndarray, k: int, rng = None) -> SparseUpdate:
+        """Compress a numpy array using Rand-k compression into a SparseUpdate
+
+        Parameters
+        ----------
+        x : np.ndarray
+            Numpy array compressed using Rand-k compression
+        k : int
+            Number of entries to retain
+        rng : np.random.Generator
+            Random number generator used for selecting elements
+
+        Raises
+        ------
+        AssertionError
+            Number of entries to retain is less than zero or greater than size
+            of numpy array
+
+        Returns
+        -------
+        SparseUpdate
+            The k retained entries, sorted by index
+        """
+        assert 0 <= k <= len(x)
+        if rng is None:
+            rng = np.random.default_rng()
+        res = np.sort(rng.choice(x.size, size=k, replace=False))
+        return SparseUpdate(res, x[res], x.shape, x.dtype)
+
+    @staticmethod
+    def seeded_indices(n: int, k: int, seed: int, block_size: int = 1) -> np.ndarray:
+        """Draw k sorted indices into range(n) from a seed
+
+        The n entries are grouped into blocks of ``block_size`` consecutive
+        entries, and the blocks are taken at evenly spaced strides from a
+        random offset, so each entry is kept with probability about k / n.
+        Only the offset is random, which makes regenerating the indices from
+        the seed as cheap as an ``arange``.
+
+        Parameters
+        ----------
+        n : int
+            Number of entries to draw from
+        k : int
+            Number of indices to draw
+        seed : int
+            Seed of the random offset
+        block_size : int
+            Number of consecutive entries kept together
+
+        Returns
+        -------
+        np.ndarray
+            The k drawn indices, sorted
+        """
+        assert 0 <= k <= n and block_size >= 1
+        if k == 0:
+            return np.arange(0)
+        num_blocks = -(-n // block_size)
+        # One spare block in case the short last block is among the kept ones
+        num_kept = min(-(-k // block_size) + (n % block_size > 0), num_blocks)
+        offset = np.random.default_rng(seed).integers(num_blocks)
+        blocks = (offset + np.arange(num_kept) * num_blocks // num_kept) % num_blocks
+        idxs = (blocks[:, np.newaxis] * block_size + np.arange(block_size)).ravel()
+        # Any surplus comes off the last block in stride order, which sits at
+        # a random position, then the wrapped-around head is moved to the end
+        idxs = idxs[idxs < n][:k]
+        wrap = np.flatnonzero(np.diff(idxs) < 0)
+        if wrap.size:
+            idxs = np.concatenate((idxs[wrap[0] + 1:], idxs[: wrap[0] + 1]))
+        return idxs
+
+    @staticmethod
+    def compress_seeded(x: np.ndarray, k: int, seed: int, block_size: int = 1) -> SparseUpdate:
+        """Compress a numpy array using Rand-k compression with seeded indices
+
+        The retained indices come from ``seeded_indices``, so only the values
+        and the seed need to be sent, see ``encoding.encode``.
+
+        Parameters
+        ----------
+        x : np.ndarray
+            Numpy array compressed using Rand-k compression
+        k : int
+            Number of entries to retain
+        seed : int
+            Seed the indices are drawn from
+        block_size : int
+            Number of consecutive entries kept together
+
+        Returns
+        -------
+        SparseUpdate
+            The k retained entries, sorted by index
+        """
+        idxs = RandKCompressor.seeded_indices(x.size, k, seed, block_size)
+        return SparseUpdate(idxs, x[idxs], x.shape, x.dtype, index_seed=(seed, block_size))
+
+    @staticmethod
+    def compress_batch(X: np.ndarray, k: int, rng = None) -> np.ndarray:
+        """Compress every row of a 2-D numpy array using Rand-k compression
+
+        Every row keeps its own k entries, drawn without replacement.
+
+        Parameters
+        ----------
+        X : np.ndarray
+            Numpy array of shape (clients, d), one flattened update per row
+        k : int
+            Number of entries to retain in every row
+        rng : np.random.Generator
+            Random number generator used for selecting elements
+
+        Raises
+        ------
+        AssertionError
+            Number of entries to retain is less than zero or greater than the
+            length of a row
+
+        Returns
+        -------
+        np.ndarray
+            Compressed numpy array
+        """
+        assert X.ndim == 2 and 0 <= k <= X.shape[1]
+        if k == 0:
+            return np.zeros_like(X)
+        if k == X.shape[1]:
+            return X
+        if rng is None:
+            rng = np.random.default_rng()
+        # The k smallest of i.i.d. uniform keys are a uniform k-subset
+        res = rng.random(X.shape).argpartition(k, axis=1)[:, :k]
+
+        CX = np.zeros_like(X)
+        np.put_along_axis(CX, res, np.take_along_axis(X, res, axis=1), axis=1)
+        return CX
+
     @staticmethod
     def getsizeof(x: np.ndarray) -> int:
         """Return the size of the numpy array (treated as sparse COO) in bytes
@@ -224,7 +717,7 @@ class RandKCompressor(Compressor):
 
         Parameters
         ----------
-        x : np.ndarray
+        x : np.ndarray or SparseUpdate
             Numpy array compressed using Rand-k compression
 
         Returns
@@ -232,6 +725,8 @@ class RandKCompressor(Compressor):
         int
             Size of the numpy array in bytes
         """
+        if isinstance(x, SparseUpdate):
+            return x.nbytes
         return (1 * 8 + x.itemsize) * np.count_nonzero(x)
 
 
@@ -267,20 +762,425 @@ def unbiased_rand_k(
 
 
 def calc_cluster_means(
-    centroids: np.ndarray, cluster_assignments: np.ndarray, data: np.ndarray
-) -> np.ndarray:
-    """Calculate cluster means given the cluster assignments and data."""
-    new_centroids = centroids.copy()
-    for cluster_id in range(len(centroids)):
-        cluster_members = np.argwhere(cluster_assignments == cluster_id)
-        if cluster_members.size == 0:  # Handle emptied clusters
-            new_centroids[cluster_id] = 0
-        else:
-            new_centroids[cluster_id] = data[cluster_members].mean()
+    centroids: np.ndarray,
+    cluster_assignments: np.ndarray,
+    data: np.ndarray,
+    return_counts: bool = False,
+    counts: np.ndarray = None,
+) -> Union[np.ndarray, Tuple[np.ndarray, np.ndarray]]:
+    """Calculate cluster means given the cluster assignments and data.
+
+    Sums and sizes of all clusters are computed in a single pass with
+    ``np.bincount``. Cluster sizes the caller already knows can be passed as
+    ``counts`` to skip counting the labels again. If ``return_counts`` is
+    True, the number of members of every cluster is returned as well.
+    """
+    labels = np.ravel(cluster_assignments)
+    if counts is None:
+        counts = np.bincount(labels, minlength=len(centroids))
+    sums = np.bincount(labels, weights=np.ravel(data), minlength=len(centroids))
 
+    new_centroids = np.zeros_like(centroids)  # Emptied clusters are set to 0
+    nonempty = counts > 0
+    new_centroids[nonempty] = sums[nonempty] / counts[nonempty]
+
+    if return_counts:
+        return new_centroids, counts
     return new_centroids
 
 
+class _Sorted1D(NamedTuple):
+    """A flattened vector sorted once and shared by the sort-based engines."""
+
+    x: np.ndarray  # flattened data in the original order
+    order: np.ndarray  # argsort of x
+    xs: np.ndarray  # x[order]
+    csum: np.ndarray  # prefix sums of xs, with a leading zero
+
+
+def _sort_1d(g: np.ndarray) -> _Sorted1D:
+    """Sort the flattened vector g and precompute its prefix sums."""
+    x = g.ravel()
+    order = np.argsort(x, kind="stable")
+    xs = x[order]
+    # Prefix sums stay float64 whatever the precision, float32 ones lose the
+    # small cluster sums of multi-million-entry layers to rounding
+    csum = np.concatenate(([0.0], np.cumsum(xs, dtype=np.float64)))
+    return _Sorted1D(x, order, xs, csum)
+
+
+def _refine_bounds(XS: np.ndarray, inner: np.ndarray, c_lo, c_hi, right_wins_tie) -> np.ndarray:
+    """Move segment boundaries past points the rounded midpoint misplaces.
+
+    ``inner[r, j]`` splits row r of the sorted data XS between centroids
+    ``c_lo[r, j]`` and ``c_hi[r, j]``. The dense engine compares the float
+    squared distances to both centroids instead, and for points on or next
+    to the rounded midpoint the two can disagree (e.g. 2.0 is the rounded
+    midpoint of 4/3 and 8/3, yet closer to 8/3 in float). Boundaries are
+    walked until every point agrees with the squared distances, exact ties
+    going to ``right_wins_tie``.
+    """
+    m, n = XS.shape
+    rows = np.arange(m)[:, np.newaxis]
+
+    def prefers_right(p):
+        x = XS[rows, np.clip(p, 0, n - 1)]
+        d_lo = np.square(x - c_lo)
+        d_hi = np.square(x - c_hi)
+        return (d_hi < d_lo) | ((d_hi == d_lo) & right_wins_tie)
+
+    while True:
+        down = (inner > 0) & prefers_right(inner - 1)
+        up = (inner < n) & ~down & ~prefers_right(inner)
+        if not (down.any() or up.any()):
+            return np.maximum.accumulate(inner, axis=1)
+        inner = inner - down + up
+
+
+def _segment_bounds(xs: np.ndarray, theta: np.ndarray):
+    """Split sorted 1-D data into nearest-centroid segments.
+
+    Returns the centroid index owning each segment (in increasing centroid
+    order) and the ``len(ids) + 1`` segment boundaries into ``xs``. Points
+    go to the centroid with the smaller float squared distance, and
+    duplicate centroids and exact ties resolve to the lowest centroid index,
+    which is what ``np.argmin`` does in the dense engine.
+    """
+    order = np.argsort(theta, kind="stable")
+    c = theta[order]
+    unique = np.ones(c.size, dtype=bool)
+    unique[1:] = c[1:] != c[:-1]
+    ids, c = order[unique], c[unique]
+    mids = (c[:-1] + c[1:]) / 2
+    right_wins_tie = ids[1:] < ids[:-1]
+    inner = np.where(
+        right_wins_tie,
+        np.searchsorted(xs, mids, side="left"),
+        np.searchsorted(xs, mids, side="right"),
+    )
+    inner = _refine_bounds(xs[np.newaxis], inner[np.newaxis], c[:-1], c[1:], right_wins_tie)[0]
+    bounds = np.concatenate(([0], inner, [xs.size]))
+    return ids, bounds
+
+
+def _sorted_labels(order: np.ndarray, ids: np.ndarray, bounds: np.ndarray) -> np.ndarray:
+    """Scatter per-segment cluster ids back to the original data order."""
+    l = np.empty(order.size, dtype=np.intp)
+    l[order] = np.repeat(ids, np.diff(bounds))
+    return l
+
+
+def _budget_reassignment(
+    x: np.ndarray, l: np.ndarray, theta: np.ndarray, n_j: int, b: int, budget: float
+) -> np.ndarray:
+    """Positions the sparsity step of compress_b resets to the zero cluster."""
+    xi2 = np.fmax(np.square(x) - np.square(x - theta[l]), 0)
+    num_exceeded = int(np.ceil(n_j - (budget / b)))
+    # Mirrors the dense engine exactly, including indexing l with positions
+    # into the nonzero subset of xi2.
+    return np.argpartition(xi2[np.nonzero(xi2)], num_exceeded + 1)[: num_exceeded + 1]
+
+
+def _nearest_labels(x: np.ndarray, theta: np.ndarray) -> np.ndarray:
+    """Assign unsorted 1-D data to the nearest centroid in O(n log k).
+
+    Labels agree with ``_segment_bounds`` and the dense engine: the float
+    squared distances decide, and exact ties go to the lowest centroid index.
+    """
+    order = np.argsort(theta, kind="stable")
+    c = theta[order]
+    unique = np.ones(c.size, dtype=bool)
+    unique[1:] = c[1:] != c[:-1]
+    ids, c = order[unique], c[unique]
+    p = np.searchsorted((c[:-1] + c[1:]) / 2, x)
+    # Points on or next to a rounded midpoint may be closer, in float, to the
+    # neighbouring centroid
+    for shift in (-1, 1):
+        q = np.clip(p + shift, 0, c.size - 1)
+        d_p = np.square(x - c[p])
+        d_q = np.square(x - c[q])
+        p = np.where((d_q < d_p) | ((d_q == d_p) & (ids[q] < ids[p])), q, p)
+    return ids[p]
+
+
+def _fit_sample(
+    x: np.ndarray, approx: str, approx_size: int, rng: np.random.Generator
+) -> np.ndarray:
+    """Draw the small set of points the approximate mode fits centroids on.
+
+    ``"sample"`` takes one uniformly drawn entry from each of ``approx_size``
+    equally sized strata of x. ``"sketch"`` builds an ``approx_size``-bin
+    histogram of x and reads ``approx_size`` evenly spaced quantiles off it,
+    interpolating linearly inside each bin.
+    """
+    n = x.size
+    if approx_size >= n:
+        return x
+    if approx == "sample":
+        if rng is None:
+            rng = np.random.default_rng()
+        stride = n / approx_size
+        idx = ((np.arange(approx_size) + rng.random(approx_size)) * stride).astype(np.intp)
+        return x[np.minimum(idx, n - 1)]
+    if approx == "sketch":
+        counts, edges = np.histogram(x, bins=approx_size)
+        ranks = (np.arange(approx_size) + 0.5) * (n / approx_size)
+        cdf = np.cumsum(counts)
+        bins = np.searchsorted(cdf, ranks, side="right")
+        below = cdf[bins] - counts[bins]
+        frac = (ranks - below) / counts[bins]
+        return edges[bins] + frac * (edges[bins + 1] - edges[bins])
+    raise ValueError("approx must be one of 'sample' or 'sketch', got %r" % approx)
+
+
+def _split_centroids(
+    data: _Sorted1D, theta: np.ndarray, enforce_constraint: bool
+) -> np.ndarray:
+    """Double the number of centroids to warm-start the next bit-depth.
+
+    Every cluster of the previous level is cut at its centroid and replaced
+    by the means of its two halves (an empty half keeps the old centroid).
+    When the zero centroid is pinned it is kept as is, and only the half of
+    its cluster whose own centroid would reduce the objective the most
+    (largest sum**2 / count) is added.
+    """
+    ids, bounds = _segment_bounds(data.xs, theta)
+    lo = np.zeros(theta.size, dtype=np.intp)
+    hi = np.zeros(theta.size, dtype=np.intp)
+    lo[ids], hi[ids] = bounds[:-1], bounds[1:]
+    cut = np.clip(np.searchsorted(data.xs, theta), lo, hi)
+
+    def half_means(start, stop):
+        count = stop - start
+        total = data.csum[stop] - data.csum[start]
+        means = np.where(count > 0, total / np.maximum(count, 1), theta)
+        return means, total * total / np.maximum(count, 1)
+
+    left, left_gain = half_means(lo, cut)
+    right, right_gain = half_means(cut, hi)
+    if not enforce_constraint:
+        return np.concatenate((left, right))
+
+    zero_half = left[0] if left_gain[0] > right_gain[0] else right[0]
+    return np.concatenate(([0, zero_half], left[1:], right[1:]))
+
+
+def _compress_b_sorted(
+    data: _Sorted1D,
+    b: int,
+    budget: int,
+    n_iters: int,
+    tol: float,
+    enforce_constraint: bool,
+    init: np.ndarray = None,
+) -> Union[np.float64, np.ndarray, np.ndarray]:
+    """Squared-distance 1-D engine for compress_b.
+
+    The data is sorted once. Every iteration then only needs the k - 1
+    midpoint boundaries (found with ``searchsorted``) and the prefix sums of
+    the sorted data to get cluster sizes and sums, instead of an n x k
+    distance matrix. Per-point labels are only materialized when the sparsity
+    constraint has to reassign entries and once at the end.
+    """
+    k = 2 ** b  # Number of clusters
+
+    x, order, xs, csum = data
+    n = x.size
+
+    # Same initialization as the dense engine, see compress_b
+    dtype = _compute_dtype(xs)
+    if init is None:
+        theta = np.linspace(start=0, stop=xs[-1], num=k, dtype=dtype)
+    else:
+        theta = np.array(init, dtype=dtype)
+
+    for i in range(n_iters):
+        ids, bounds = _segment_bounds(xs, theta)
+        counts = np.zeros(k, dtype=np.intp)
+        counts[ids] = np.diff(bounds)
+        sums = np.zeros(k, dtype=np.float64)
+        sums[ids] = csum[bounds[1:]] - csum[bounds[:-1]]
+        l = None
+
+        n_j = n - counts[0]
+        if n_j > budget / b and enforce_constraint:  # constraint not fulfilled
+            l = _sorted_labels(order, ids, bounds)
+            smallest_xi2 = _budget_reassignment(x, l, theta, n_j, b, budget)
+            moved = smallest_xi2[l[smallest_xi2] != 0]
+            counts -= np.bincount(l[moved], minlength=k)
+            sums -= np.bincount(l[moved], weights=x[moved], minlength=k)
+            counts[0] += moved.size
+            sums[0] += x[moved].sum()
+            l[smallest_xi2] = 0
+
+        theta_new = np.zeros_like(theta)
+        nonempty = counts > 0
+        theta_new[nonempty] = sums[nonempty] / counts[nonempty]
+        if enforce_constraint:
+            theta_new[0] = 0  # Retain zero as a centroid for sparsification
+
+        if mse(theta_new, theta) < tol:
+            theta = theta_new
+            break
+        theta = theta_new
+
+    if l is None:
+        l = _sorted_labels(order, ids, bounds)
+
+    ids, bounds = _segment_bounds(xs, theta)
+    objective = np.square(xs - np.repeat(theta[ids], np.diff(bounds))).sum()
+
+    return objective, l, theta
+
+
+def _segment_sse(p1: np.ndarray, p2: np.ndarray, j: np.ndarray, i: np.ndarray) -> np.ndarray:
+    """Within-segment sum of squared errors of the sorted points [j, i)."""
+    s = p1[i] - p1[j]
+    return np.fmax((p2[i] - p2[j]) - s * s / np.maximum(i - j, 1), 0)
+
+
+def _kmeans_1d_layer(prev: np.ndarray, p1: np.ndarray, p2: np.ndarray):
+    """One layer of the 1-D k-means dynamic program.
+
+    Computes ``cur[i] = min_{j <= i} prev[j] + SSE(j, i)`` for every prefix
+    length i, together with the minimizing split j. The optimal split is
+    monotone in i, so the divide-and-conquer optimization applies; all
+    subproblems of one recursion level are evaluated in a single vectorized
+    pass, which costs O(n) per level and O(n log n) per layer.
+    """
+    n1 = prev.size
+    cur = np.empty(n1)
+    opt = np.empty(n1, dtype=np.intp)
+    # Pending subproblems: rows [lo, hi] whose optimal split lies in [olo, ohi]
+    lo, hi = np.array([0]), np.array([n1 - 1])
+    olo, ohi = np.array([0]), np.array([n1 - 1])
+    while lo.size:
+        mid = (lo + hi) // 2
+        width = np.minimum(ohi, mid) - olo + 1
+        starts = np.cumsum(width) - width
+        owner = np.repeat(np.arange(mid.size), width)
+        j = np.arange(width.sum()) - starts[owner] + olo[owner]
+        cost = prev[j] + _segment_sse(p1, p2, j, mid[owner])
+
+        best_cost = np.minimum.reduceat(cost, starts)
+        # Leftmost minimizer of every subproblem
+        pos = np.where(cost == best_cost[owner], np.arange(cost.size), cost.size)
+        best = j[np.minimum.reduceat(pos, starts)]
+        cur[mid] = best_cost
+        opt[mid] = best
+
+        left = lo < mid
+        right = mid < hi
+        lo = np.concatenate((lo[left], mid[right] + 1))
+        hi = np.concatenate((mid[left] - 1, hi[right]))
+        olo = np.concatenate((olo[left], best[right]))
+        ohi = np.concatenate((best[left], ohi[right]))
+    return cur, opt
+
+
+def _kmeans_1d_tables(y: np.ndarray, num_layers: int):
+    """Cost and split tables for 0..num_layers clusters over prefixes of y."""
+    p1 = np.concatenate(([0.0], np.cumsum(y)))
+    p2 = np.concatenate(([0.0], np.cumsum(y * y)))
+    cost = np.full(y.size + 1, np.inf)
+    cost[0] = 0
+    costs, splits = [cost], [None]
+    for _ in range(num_layers):
+        cost, split = _kmeans_1d_layer(cost, p1, p2)
+        costs.append(cost)
+        splits.append(split)
+    return costs, splits
+
+
+def _backtrack_segments(splits: list, m: int, i: int) -> list:
+    """Recover the m segment boundaries (j, i) of the first i points."""
+    segments = []
+    for layer in range(m, 0, -1):
+        j = splits[layer][i]
+        segments.append((j, i))
+        i = j
+    return segments[::-1]
+
+
+# The DP tables of the exact engine take about 45 bytes per (cluster, point)
+# cell, so it is limited to a few bits and to at most this many cells (~380MB)
+EXACT_MAX_BITS = 4
+EXACT_MAX_CELLS = 2 ** 23
+
+
+def _compress_b_exact(
+    data: _Sorted1D, b: int, budget: int, enforce_constraint: bool
+) -> Union[np.float64, np.ndarray, np.ndarray]:
+    """Globally optimal 1-D sparse k-means by dynamic programming.
+
+    In the optimal solution every cluster, including the one pinned at zero,
+    is a contiguous run of the sorted data. The zero run [s, e) costs the sum
+    of its squares and must hold at least ``n - budget / b`` points, and the
+    points left and right of it are split optimally into the remaining
+    ``k - 1`` clusters (Ckmeans.1d.dp with a divide-and-conquer speedup).
+    Memory use is O(k n), hence b is capped at ``EXACT_MAX_BITS`` and k n at
+    ``EXACT_MAX_CELLS``.
+    """
+    k = 2 ** b  # Number of clusters
+
+    n = data.x.size
+    assert b <= EXACT_MAX_BITS, "exact mode supports at most %d bits" % EXACT_MAX_BITS
+    assert k * n <= EXACT_MAX_CELLS, (
+        "exact mode needs O(k n) memory, %d clusters x %d points exceeds %d cells"
+        % (k, n, EXACT_MAX_CELLS))
+    order = data.order
+    xs = data.xs.astype(np.float64)
+    # SSE is shift invariant, centering keeps the prefix sums well conditioned
+    y = xs - xs[n // 2]
+
+    labels = np.empty(n, dtype=np.intp)
+    theta = np.zeros(k)
+    if not enforce_constraint:
+        costs, splits = _kmeans_1d_tables(y, k)
+        segments = _backtrack_segments(splits, k, n)
+    else:
+        max_nonzero = min(n, int(np.floor(budget / b)))
+        min_zero_run = n - max_nonzero
+        left_costs, left_splits = _kmeans_1d_tables(y, k - 1)
+        right_costs, right_splits = _kmeans_1d_tables(-y[::-1], k - 1)
+        z2 = np.concatenate(([0.0], np.cumsum(xs * xs)))
+
+        best = None
+        for k_left in range(k):
+            k_right = k - 1 - k_left
+            # cost(s, e) = left(s) + z2[e] - z2[s] + right(e), e - s >= min_zero_run
+            head = left_costs[k_left] - z2
+            tail = z2 + right_costs[k_right][::-1]
+            tail_min = np.minimum.accumulate(tail[::-1])[::-1]
+            total = head[: n + 1 - min_zero_run] + tail_min[min_zero_run:]
+            s = int(np.argmin(total))
+            if best is None or total[s] < best[0]:
+                e = s + min_zero_run + int(np.argmin(tail[s + min_zero_run :]))
+                best = (total[s], k_left, s, e)
+
+        _, k_left, s, e = best
+        left = _backtrack_segments(left_splits, k_left, s)
+        # The right tables were built on the reversed data
+        right = [
+            (n - i, n - j)
+            for j, i in _backtrack_segments(right_splits, k - 1 - k_left, n - e)
+        ]
+        segments = [(s, e)] + left + right
+
+    for cluster_id, (j, i) in enumerate(segments):
+        labels[j:i] = cluster_id
+        if i > j:  # Emptied clusters keep a zero centroid
+            theta[cluster_id] = xs[j:i].mean()
+    if enforce_constraint:
+        theta[0] = 0  # The zero run is the sparsifying cluster
+
+    l = np.empty(n, dtype=np.intp)
+    l[order] = labels
+    objective = np.square(xs - theta[labels]).sum()
+
+    return objective, l, theta
+
+
 def compress_b(
     g: np.ndarray,
     b: int,
@@ -289,27 +1189,54 @@ def compress_b(
     tol: float = 1e-8,
     enforce_constraint: bool = True,
     dist_fn: Callable[[np.ndarray, np.ndarray], np.ndarray] = None,
+    exact: bool = False,
+    init: np.ndarray = None,
 ) -> Union[np.float64, np.ndarray, np.ndarray]:
     """
     Compress the gradient vector g to using a bit-depth b.
+
+    With the default squared distance the sort-based 1-D engine is used,
+    which never materializes the n x k distance matrix. Passing a custom
+    ``dist_fn`` falls back to the generic dense engine. ``exact=True`` skips
+    Lloyd iterations altogether and returns the globally optimal clustering
+    under the same zero centroid and ``budget / b`` constraint. Its tables
+    take O(2^b n) memory, so it is limited to ``b <= EXACT_MAX_BITS`` and
+    ``2^b n <= EXACT_MAX_CELLS``; use it on small layers or with ``approx``
+    in sparse_kmeans. ``init``
+    replaces the evenly spread initial centroids of the iterative engines.
     """
     assert budget is not None and budget > 0, "budget must be an integer greater than 0"
     assert b > 0, "must have positive number of bits b"
+
+    if exact:
+        assert dist_fn is None, "exact mode only supports the squared distance"
+        return _compress_b_exact(_sort_1d(g), b, budget, enforce_constraint)
+    if dist_fn is None:
+        return _compress_b_sorted(
+            _sort_1d(g), b, budget, n_iters, tol, enforce_constraint, init
+        )
+
     k = 2 ** b  # Number of clusters
 
     # distance measure
     # dist = lambda x: np.sqrt(np.square(x))  # alternative
-    if dist_fn is None:
-        dist_fn = lambda x: np.square(np.abs(x))
+    # The sort-based engine hardcodes dist = lambda x: np.square(np.abs(x))
 
     bottomk = lambda A, k: np.argpartition(A, k)[:k]
 
+    # The dense engine broadcasts a column of points against the centroids
+    g = g.reshape(-1, 1)
+
     # Step 1: Initialize centroids
     # Initialize centroids roughly evenly across the range
     # Make sure to start at zero because we need a centroid
     # at zero that we do not update to act as a sparsifier.
     # TODO: What if this is randomly sampled rather than evenly spread?
-    theta = np.linspace(start=0, stop=np.max(g), num=k)
+    dtype = _compute_dtype(g)
+    if init is None:
+        theta = np.linspace(start=0, stop=np.max(g), num=k, dtype=dtype)
+    else:
+        theta = np.array(init, dtype=dtype)
     # TODO: add a flag to change between even initialization and random
     # initialization so that I'm not commenting/uncommenting constantly
 
@@ -330,7 +1257,10 @@ def compress_b(
         # If constraint is not fulfilled, change labels l_i to zero
         # for which xi^2_i is smallest until constraint not fulfilled.
         # NOTE: This can delete a cluster!
-        n_j = np.count_nonzero(l)
+        # The cluster sizes are counted once here and kept up to date through
+        # the reassignment, so the means below do not count the labels again
+        counts = np.bincount(l, minlength=k)
+        n_j = l.size - counts[0]
         if n_j > budget / b and enforce_constraint:  # constraint not fulfilled
             num_exceeded = int(np.ceil(n_j - (budget / b)))
             # Indexes of smallest, nonzero values in xi2. The fmax means theta_new
@@ -338,15 +1268,19 @@ def compress_b(
             # that does us no good.
             # TODO: Figure out if this modification is sensible.
             smallest_xi2 = bottomk(xi2[np.nonzero(xi2)], num_exceeded + 1)
+            counts -= np.bincount(l[smallest_xi2], minlength=k)
+            counts[0] += smallest_xi2.size
             l[smallest_xi2] = 0
-            n_j = np.count_nonzero(l)
+            n_j = l.size - counts[0]
         # NOTE: Avoid this assertion because it can cause other issues. Need a
         # different way of logging situations where the constraint is _still_
         # violated
         # assert n_j <= budget / b, "sparsity constrain violated"
 
         # Step 4: Update cluster means
-        theta_new = calc_cluster_means(centroids=theta, cluster_assignments=l, data=g)
+        theta_new = calc_cluster_means(
+            centroids=theta, cluster_assignments=l, data=g, counts=counts
+        )
         if enforce_constraint:
             theta_new[0] = 0  # Retain zero as a centroid for sparsification
 
@@ -364,31 +1298,713 @@ def compress_b(
     return objective, l, theta
 
 
-def sparse_kmeans(
-    gradient: np.ndarray, budget: int = None, enforce_constraint: bool = True
-) -> np.ndarray:
-    """Find optimal number of bits to compress gradient vector."""
-    previous_objective = None
-    for b in range(1, 3):
-        inner_objective, cluster_assignments, centroids = compress_b(
-            gradient, b, budget, enforce_constraint=enforce_constraint
-        )
+class CentroidCache:
+    """Bounded LRU cache of k-means centroids used to warm-start clients.
+
+    Entries are keyed by ``(client_id, layer, b)`` and hold the centroids the
+    client last converged to for that layer and bit-depth. The least recently
+    used entries are evicted once the cache takes more than ``max_bytes``, so
+    it stays bounded however many clients there are. An entry is charged for
+    its centroid array, its key and ``ENTRY_OVERHEAD`` bytes of bookkeeping
+    in the ordered dict, which dominate for small layers.
+
+    Attributes
+    ----------
+    hits : int
+        Number of lookups that found centroids
+    misses : int
+        Number of lookups that found nothing
+    nbytes : int
+        Estimated bytes currently held by the cache
+    """
+
+    # Bytes an OrderedDict spends per entry on its hash table and order links
+    ENTRY_OVERHEAD = 112
+
+    def __init__(self, max_bytes: int = 64 * 2 ** 20):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.nbytes = 0
+        self._entries = OrderedDict()
+        # Layers may be compressed concurrently
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @classmethod
+    def _entry_bytes(cls, key: tuple, centroids: np.ndarray) -> int:
+        key_bytes = sys.getsizeof(key) + sum(sys.getsizeof(k) for k in key)
+        return sys.getsizeof(centroids) + key_bytes + cls.ENTRY_OVERHEAD
+
+    def get(self, client_id: Hashable, layer: Hashable, b: int) -> np.ndarray:
+        """Return the cached centroids, or None on a miss."""
+        key = (client_id, layer, b)
+        with self._lock:
+            centroids = self._entries.get(key)
+            if centroids is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return centroids
+
+    def put(self, client_id: Hashable, layer: Hashable, b: int, centroids: np.ndarray):
+        """Store centroids, evicting the least recently used entries if needed."""
+        key = (client_id, layer, b)
+        centroids = np.array(centroids)
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._entry_bytes(key, self._entries.pop(key))
+            self._entries[key] = centroids
+            self.nbytes += self._entry_bytes(key, centroids)
+            while self.nbytes > self.max_bytes and self._entries:
+                evicted_key, evicted = self._entries.popitem(last=False)
+                self.nbytes -= self._entry_bytes(evicted_key, evicted)
+
+
+def _search_bits(
+    data: _Sorted1D,
+    budget: float,
+    enforce_constraint: bool,
+    exact: bool,
+    min_bits: int,
+    max_bits: int,
+    cache: CentroidCache = None,
+    cache_key: Tuple[Hashable, Hashable] = None,
+):
+    """Bit-depth search of sparse_kmeans, returns (error, b, labels, centroids)."""
+    best = None
+    for b in range(min_bits, max_bits + 1):
+        if exact:
+            result = _compress_b_exact(data, b, budget, enforce_constraint)
+        else:
+            init = None
+            if cache is not None:
+                init = cache.get(*cache_key, b)
+            if init is None and best is not None:
+                init = _split_centroids(data, best[3], enforce_constraint)
+            result = _compress_b_sorted(
+                data, b, budget, 10, 1e-8, enforce_constraint, init
+            )
+            if cache is not None:
+                cache.put(*cache_key, b, result[2])
+        # Compare levels on the error of the constrained assignment, the
+        # nearest-centroid objective keeps shrinking as b grows.
+        _, l, theta = result
+        inner_objective = np.square(data.x - theta[l]).sum()
         #print(f"{b=}, {inner_objective=}")
 
-        if previous_objective is None or inner_objective < previous_objective:
-            previous_objective = inner_objective
+        if best is None or inner_objective < best[0]:
+            best = (inner_objective, b, l, theta)
         else:
             break
+    return best
+
 
-    # Construct compressed gradient
-    compressed_gradient = gradient.copy()
-    for i, centroid in enumerate(centroids):
-        compressed_gradient[cluster_assignments == i] = centroid
+def _min_max_scale(g: np.ndarray):
+    """Scale the flattened g to [0, 1] in a single copy.
 
-    compression_error = mse(gradient, compressed_gradient)
+    Return the scaled copy, the shift and the range, with a zero range
+    treated as 1 like sklearn's ``MinMaxScaler`` does.
+    """
+    x = np.array(g, dtype=_compute_dtype(g)).ravel()
+    shift = x.min()
+    data_range = (x.max() - shift) or 1.0
+    x -= shift
+    x /= data_range
+    return x, shift, data_range
+
+
+def _codebook_sse(
+    x: np.ndarray, labels: np.ndarray, centroids: np.ndarray, block_size: int = 2 ** 16
+) -> float:
+    """Squared error of x against ``centroids[labels]`` from per-cluster sums.
+
+    Counts and sums of every cluster and the sum of squares of x are
+    accumulated in float64 over fixed-size blocks, so unlike ``mse`` no
+    dense copy of the compressed vector is built.
+    """
+    k = len(centroids)
+    counts = np.zeros(k)
+    sums = np.zeros(k)
+    squares = 0.0
+    for start in range(0, x.size, block_size):
+        block = x[start:start + block_size].astype(np.float64)
+        block_labels = labels[start:start + block_size]
+        counts += np.bincount(block_labels, minlength=k)
+        sums += np.bincount(block_labels, weights=block, minlength=k)
+        squares += np.dot(block, block)
+    c = centroids.astype(np.float64)
+    return max(squares - 2 * np.dot(c, sums) + np.dot(counts, c * c), 0.0)
+
+
+def _assign_full(
+    x: np.ndarray, theta: np.ndarray, b: int, budget: int, enforce_constraint: bool
+) -> np.ndarray:
+    """Single assignment pass of fitted centroids over every entry of x."""
+    l = _nearest_labels(x, theta)
+    n_j = np.count_nonzero(l)
+    if n_j > budget / b and enforce_constraint:
+        l[_budget_reassignment(x, l, theta, n_j, b, budget)] = 0
+    return l
 
+
+def sparse_kmeans(
+    gradient: np.ndarray,
+    budget: int = None,
+    enforce_constraint: bool = True,
+    exact: bool = False,
+    min_bits: int = 1,
+    max_bits: int = 2,
+    approx: str = None,
+    approx_size: int = 65536,
+    rng=None,
+    cache: CentroidCache = None,
+    cache_key: Tuple[Hashable, Hashable] = None,
+    scale: bool = False,
+    sparse: bool = False,
+) -> np.ndarray:
+    """Find optimal number of bits to compress gradient vector.
+
+    Bit-depths from ``min_bits`` up to ``max_bits`` (at most 8) are tried in
+    order, and the search stops at the first level whose constrained
+    assignment does not lower the squared error. The gradient is sorted once
+    for all levels, and each level is warm-started by splitting the
+    centroids of the previous one.
+
+    ``exact`` fits every level with the O(2^b n)-memory dynamic program of
+    ``compress_b``, so it caps ``max_bits`` at ``EXACT_MAX_BITS`` and is only
+    meant for layers, or ``approx`` samples, of a few hundred thousand
+    entries.
+
+    With ``approx`` set to ``"sample"`` or ``"sketch"``, the bit-depth and
+    centroids are fitted on ``approx_size`` points drawn from the gradient
+    (see ``_fit_sample``) with a proportionally scaled budget, followed by one
+    vectorized assignment pass over all entries. ``approximation_gap``
+    measures what this costs compared with fitting on every entry.
+
+    Given a ``CentroidCache`` and a ``(client_id, layer)`` ``cache_key``, every
+    level starts from the centroids cached for it, if any, and stores the
+    centroids it converges to.
+
+    With ``scale``, the gradient is min-max scaled to [0, 1] like sklearn's
+    ``MinMaxScaler`` before clustering, so the pinned zero centroid sits at
+    ``min(gradient)``. Only the centroids are mapped back to the original
+    scale. With ``sparse``, the compressed gradient is returned as a
+    SparseUpdate whose codebook holds those centroids, so decoding it is a
+    table lookup instead of a dense inverse transform. The compression error
+    is then computed from per-cluster sums, and no dense compressed gradient
+    is built at all.
+    """
+    assert 1 <= min_bits <= max_bits <= 8, "bit-depths must lie in [1, 8]"
+    assert not exact or max_bits <= EXACT_MAX_BITS, (
+        "exact mode supports at most %d bits" % EXACT_MAX_BITS)
+    assert budget is not None and budget > 0, "budget must be an integer greater than 0"
+    assert cache is None or cache_key is not None, "cache requires a cache_key"
+
+    x = gradient.ravel()
+    if scale:
+        x, shift, data_range = _min_max_scale(gradient)
+
+    if approx is None:
+        _, b, cluster_assignments, centroids = _search_bits(
+            _sort_1d(x),
+            budget,
+            enforce_constraint,
+            exact,
+            min_bits,
+            max_bits,
+            cache,
+            cache_key,
+        )
+    else:
+        sample = _fit_sample(x, approx, approx_size, rng)
+        _, b, _, centroids = _search_bits(
+            _sort_1d(sample),
+            budget * sample.size / x.size,
+            enforce_constraint,
+            exact,
+            min_bits,
+            max_bits,
+            cache,
+            cache_key,
+        )
+        cluster_assignments = _assign_full(x, centroids, b, budget, enforce_constraint)
+
+    if scale:
+        centroids = centroids * data_range + shift
+    centroids = centroids.astype(gradient.dtype)
+
+    if not sparse:
+        # Construct compressed gradient
+        compressed_gradient = centroids[cluster_assignments].reshape(gradient.shape)
+        return compressed_gradient, mse(gradient, compressed_gradient), b
+
+    compression_error = _codebook_sse(gradient.ravel(), cluster_assignments, centroids) / len(gradient)
+    if centroids[0] == 0:
+        indices = np.flatnonzero(cluster_assignments)
+    else:
+        indices = np.arange(cluster_assignments.size)
+    labels = cluster_assignments[indices].astype(np.uint8)
+    compressed_gradient = SparseUpdate(
+        indices, labels, gradient.shape, gradient.dtype, codebook=centroids
+    )
     return compressed_gradient, compression_error, b
 
 
+def approximation_gap(
+    gradient: np.ndarray, budget: int = None, approx: str = "sample", **kwargs
+) -> float:
+    """Relative extra error of approximate sparse_kmeans over the full fit.
+
+    Runs sparse_kmeans both with ``approx`` and on every entry, with the
+    remaining keyword arguments passed to both, and returns
+    ``(approx_error - full_error) / full_error``.
+    """
+    _, approx_error, _ = sparse_kmeans(gradient, budget, approx=approx, **kwargs)
+    _, full_error, _ = sparse_kmeans(gradient, budget, **kwargs)
+    return (approx_error - full_error) / full_error
+
+
+def _batched_searchsorted(a: np.ndarray, v: np.ndarray, side: str = "left") -> np.ndarray:
+    """``np.searchsorted`` of every row of v into the same row of sorted a."""
+    m, n = a.shape
+    rows = np.arange(m)[:, np.newaxis]
+    lo = np.zeros(v.shape, dtype=np.intp)
+    hi = np.full(v.shape, n, dtype=np.intp)
+    for _ in range(n.bit_length()):
+        mid = (lo + hi) // 2
+        val = a[rows, np.minimum(mid, n - 1)]
+        go_right = val <= v if side == "right" else val < v
+        active = lo < hi
+        lo = np.where(active & go_right, mid + 1, lo)
+        hi = np.where(active & ~go_right, mid, hi)
+    return lo
+
+
+def _batched_segment_bounds(XS: np.ndarray, theta: np.ndarray):
+    """Row-wise ``_segment_bounds``.
+
+    Rows can have different numbers of distinct centroids, so instead of
+    being dropped, duplicates are moved past the largest centroid where they
+    own an empty segment.
+    """
+    order = np.argsort(theta, axis=1, kind="stable")
+    c = np.take_along_axis(theta, order, axis=1)
+    duplicate = np.zeros(c.shape, dtype=bool)
+    duplicate[:, 1:] = c[:, 1:] == c[:, :-1]
+    if duplicate.any():
+        c = np.where(duplicate, np.inf, c)
+        resort = np.argsort(c, axis=1, kind="stable")
+        order = np.take_along_axis(order, resort, axis=1)
+        c = np.take_along_axis(c, resort, axis=1)
+    mids = (c[:, :-1] + c[:, 1:]) / 2
+    right_wins_tie = order[:, 1:] < order[:, :-1]
+    inner = np.where(
+        right_wins_tie,
+        _batched_searchsorted(XS, mids, side="left"),
+        _batched_searchsorted(XS, mids, side="right"),
+    )
+    # Duplicates moved to inf never win a comparison, not even a tie
+    inner = _refine_bounds(XS, inner, c[:, :-1], c[:, 1:],
+                           right_wins_tie & np.isfinite(c[:, :-1]))
+    m, n = XS.shape
+    bounds = np.concatenate(
+        (np.zeros((m, 1), dtype=np.intp), inner, np.full((m, 1), n, dtype=np.intp)), axis=1
+    )
+    return order, bounds
+
+
+def _batched_sorted_labels(order: np.ndarray, ids: np.ndarray, bounds: np.ndarray) -> np.ndarray:
+    """Row-wise ``_sorted_labels``."""
+    m, n = order.shape
+    flat_bounds = bounds[:, 1:-1] + (n + 1) * np.arange(m)[:, np.newaxis]
+    marks = np.bincount(flat_bounds.ravel(), minlength=m * (n + 1)).reshape(m, n + 1)
+    segment = np.cumsum(marks[:, :n], axis=1)
+    l = np.empty((m, n), dtype=np.intp)
+    np.put_along_axis(l, order, np.take_along_axis(ids, segment, axis=1), axis=1)
+    return l
+
+
+def _batched_split_centroids(
+    XS: np.ndarray, csum: np.ndarray, theta: np.ndarray, enforce_constraint: bool
+) -> np.ndarray:
+    """Row-wise ``_split_centroids``."""
+    rows = np.arange(XS.shape[0])[:, np.newaxis]
+    ids, bounds = _batched_segment_bounds(XS, theta)
+    lo = np.empty(theta.shape, dtype=np.intp)
+    hi = np.empty(theta.shape, dtype=np.intp)
+    np.put_along_axis(lo, ids, bounds[:, :-1], axis=1)
+    np.put_along_axis(hi, ids, bounds[:, 1:], axis=1)
+    cut = np.clip(_batched_searchsorted(XS, theta), lo, hi)
+
+    def half_means(start, stop):
+        count = stop - start
+        total = csum[rows, stop] - csum[rows, start]
+        means = np.where(count > 0, total / np.maximum(count, 1), theta)
+        return means, total * total / np.maximum(count, 1)
+
+    left, left_gain = half_means(lo, cut)
+    right, right_gain = half_means(cut, hi)
+    if not enforce_constraint:
+        return np.concatenate((left, right), axis=1)
+
+    zero_half = np.where(left_gain[:, 0] > right_gain[:, 0], left[:, 0], right[:, 0])
+    return np.concatenate(
+        (np.zeros((theta.shape[0], 1)), zero_half[:, np.newaxis], left[:, 1:], right[:, 1:]),
+        axis=1,
+    )
+
+
+def _compress_b_sorted_batch(
+    X: np.ndarray,
+    order: np.ndarray,
+    XS: np.ndarray,
+    csum: np.ndarray,
+    b: int,
+    budget: int,
+    n_iters: int,
+    tol: float,
+    enforce_constraint: bool,
+    init: np.ndarray = None,
+):
+    """Row-wise ``_compress_b_sorted``, returns (centroids, labels).
+
+    Every row follows exactly the iterations it would on its own: rows whose
+    centroids have converged are frozen while the others keep iterating.
+    """
+    m, n = X.shape
+    k = 2 ** b  # Number of clusters
+    rows = np.arange(m)[:, np.newaxis]
+
+    if init is None:
+        theta = np.linspace(0, XS[:, -1], num=k, axis=1, dtype=_compute_dtype(XS))
+    else:
+        theta = np.array(init, dtype=_compute_dtype(XS))
+
+    active = np.ones(m, dtype=bool)
+    has_labels = np.zeros(m, dtype=bool)
+    L = np.empty((m, n), dtype=np.intp)
+    last_ids = np.empty((m, k), dtype=np.intp)
+    last_bounds = np.empty((m, k + 1), dtype=np.intp)
+    for i in range(n_iters):
+        ids, bounds = _batched_segment_bounds(XS, theta)
+        counts = np.empty((m, k), dtype=np.intp)
+        np.put_along_axis(counts, ids, np.diff(bounds, axis=1), axis=1)
+        sums = np.empty((m, k))
+        np.put_along_axis(
+            sums, ids, csum[rows, bounds[:, 1:]] - csum[rows, bounds[:, :-1]], axis=1
+        )
+
+        n_j = n - counts[:, 0]
+        violated = active & (n_j > budget / b) & enforce_constraint
+        if violated.any():
+            r = np.flatnonzero(violated)
+            l = _batched_sorted_labels(order[r], ids[r], bounds[r])
+            x = X[r]
+            # The selection size differs between rows, so this one step runs
+            # row by row with the same helper as the single-vector engine.
+            for row, j in enumerate(r):
+                smallest_xi2 = _budget_reassignment(x[row], l[row], theta[j], n_j[j], b, budget)
+                moved = smallest_xi2[l[row, smallest_xi2] != 0]
+                moved_labels = l[row, moved]
+                counts[j] -= np.bincount(moved_labels, minlength=k)
+                sums[j] -= np.bincount(moved_labels, weights=x[row, moved], minlength=k)
+                counts[j, 0] += moved.size
+                sums[j, 0] += x[row, moved].sum()
+                l[row, smallest_xi2] = 0
+            L[r] = l
+
+        has_labels[active] = violated[active]
+        last_ids[active] = ids[active]
+        last_bounds[active] = bounds[active]
+
+        theta_new = np.where(counts > 0, sums / np.maximum(counts, 1), 0)
+        if enforce_constraint:
+            theta_new[:, 0] = 0  # Retain zero as a centroid for sparsification
+
+        converged = np.mean(np.square(theta_new - theta), axis=1) < tol
+        theta[active] = theta_new[active]
+        active &= ~converged
+        if not active.any():
+            break
+
+    r = np.flatnonzero(~has_labels)
+    if r.size:
+        L[r] = _batched_sorted_labels(order[r], last_ids[r], last_bounds[r])
+
+    return theta, L
+
+
+def sparse_kmeans_batch(
+    X: np.ndarray,
+    budget: int = None,
+    enforce_constraint: bool = True,
+    min_bits: int = 1,
+    max_bits: int = 2,
+    scale: bool = False,
+    sparse: bool = False,
+    cache: CentroidCache = None,
+    cache_keys: list = None,
+):
+    """Row-wise sparse_kmeans over a (clients, d) matrix of flattened updates.
+
+    All rows are clustered together with row-vectorized NumPy, each with its
+    own bit-depth search, and every row gets the same result as a separate
+    ``sparse_kmeans`` call with the same arguments. With a ``cache``, row i
+    is warm-started and cached under ``cache_keys[i]`` like ``cache_key`` of
+    sparse_kmeans, so the keys must be distinct.
+
+    Returns the compressed matrix (a list of SparseUpdates with ``sparse``),
+    the per-row compression errors and the per-row bit-depths.
+    """
+    assert X.ndim == 2, "X must hold one flattened update per row"
+    assert 1 <= min_bits <= max_bits <= 8, "bit-depths must lie in [1, 8]"
+    assert budget is not None and budget > 0, "budget must be an integer greater than 0"
+    assert cache is None or (cache_keys is not None and len(set(cache_keys)) == len(X)), \
+        "cache requires one distinct cache key per row"
+
+    m, n = X.shape
+    dtype = _compute_dtype(X)
+    Y = X
+    if scale:
+        Y = X.astype(dtype)
+        shift = Y.min(axis=1, keepdims=True)
+        data_range = Y.max(axis=1, keepdims=True) - shift
+        data_range[data_range == 0] = 1.0
+        Y -= shift
+        Y /= data_range
+    order = np.argsort(Y, axis=1, kind="stable")
+    YS = np.take_along_axis(Y, order, axis=1)
+    csum = np.concatenate(
+        (np.zeros((m, 1)), np.cumsum(YS, axis=1, dtype=np.float64)), axis=1
+    )
+
+    best_theta = np.zeros((m, 2 ** max_bits), dtype=dtype)
+    best_L = np.zeros((m, n), dtype=np.uint8)
+    best_error = np.full(m, np.inf)
+    bits = np.zeros(m, dtype=int)
+    searching = np.arange(m)
+    theta = None
+    for b in range(min_bits, max_bits + 1):
+        s = searching
+        init = None
+        if theta is not None:
+            init = _batched_split_centroids(YS[s], csum[s], theta, enforce_constraint)
+        if cache is not None:
+            cached = [cache.get(*cache_keys[j], b) for j in s]
+            if any(c is not None for c in cached):
+                if init is None:
+                    init = np.linspace(0, YS[s, -1], num=2 ** b, axis=1, dtype=_compute_dtype(YS))
+                for row, c in enumerate(cached):
+                    if c is not None:
+                        init[row] = c
+        theta, L = _compress_b_sorted_batch(
+            Y[s], order[s], YS[s], csum[s], b, budget, 10, 1e-8, enforce_constraint, init
+        )
+        if cache is not None:
+            for row, j in enumerate(s):
+                cache.put(*cache_keys[j], b, theta[row])
+        # Same stopping rule as _search_bits
+        error = np.square(Y[s] - np.take_along_axis(theta, L, axis=1)).sum(axis=1)
+        improved = error < best_error[s]
+        r = s[improved]
+        best_error[r] = error[improved]
+        bits[r] = b
+        best_theta[r, : 2 ** b] = theta[improved]
+        best_L[r] = L[improved]
+        searching, theta = r, theta[improved]
+        if not searching.size:
+            break
+
+    if scale:
+        best_theta = best_theta * data_range + shift
+    best_theta = best_theta.astype(X.dtype)
+    if not sparse:
+        CX = np.take_along_axis(best_theta, best_L.astype(np.intp), axis=1)
+        return CX, np.square(np.linalg.norm(X - CX, axis=1)) / n, bits
+
+    CX = []
+    compression_errors = np.empty(m)
+    for i, (x, theta, l, b) in enumerate(zip(X, best_theta, best_L, bits)):
+        compression_errors[i] = _codebook_sse(x, l, theta) / n
+        indices = np.flatnonzero(l) if theta[0] == 0 else np.arange(n)
+        CX.append(SparseUpdate(indices, l[indices], (n,), X.dtype, codebook=theta[: 2 ** b]))
+    return CX, compression_errors, bits
+
+
+class ResidualStore:
+    """Bounded per-client store of error-feedback residuals.
+
+    Residuals are keyed by ``(client_id, layer)`` and kept in RAM as ``dtype``
+    arrays, float16 halving their footprint at some loss of precision. Once
+    they take more than ``max_bytes``, the least recently used residuals
+    are written to memory-mapped ``.npy`` files and read back the next time
+    the client is selected. The files live in a temporary directory the
+    store creates under ``spill_dir``, which ``close`` removes, and which is
+    also removed when the store is garbage collected or the interpreter
+    exits. Without a ``spill_dir`` residuals are dropped instead, and the
+    client restarts from a zero residual.
+
+    Attributes
+    ----------
+    nbytes : int
+        Bytes currently held in RAM
+    spilled : int
+        Number of residuals currently spilled to disk
+    """
+
+    def __init__(self, max_bytes: int = 256 * 2 ** 20, dtype=np.float32, spill_dir: str = None):
+        self.max_bytes = max_bytes
+        self.dtype = np.dtype(dtype)
+        self.spill_dir = spill_dir
+        self.nbytes = 0
+        self._entries = OrderedDict()
+        self._spilled = {}
+        self._num_files = 0
+        # Layers may be compressed concurrently
+        self._lock = threading.RLock()
+        self._spill_tmp = None
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+            self._spill_tmp = tempfile.TemporaryDirectory(prefix="residuals_", dir=spill_dir)
+
+    @property
+    def spilled(self) -> int:
+        return len(self._spilled)
+
+    def __len__(self) -> int:
+        return len(self._entries) + len(self._spilled)
+
+    def __contains__(self, key: Tuple[Hashable, Hashable]) -> bool:
+        return key in self._entries or key in self._spilled
+
+    def get(self, client_id: Hashable, layer: Hashable) -> np.ndarray:
+        """Return the residual, or None if the client has none."""
+        key = (client_id, layer)
+        with self._lock:
+            residual = self._entries.get(key)
+            if residual is not None:
+                self._entries.move_to_end(key)
+                return residual
+            path = self._spilled.pop(key, None)
+            if path is None:
+                return None
+            residual = np.array(np.load(path, mmap_mode="r"))
+            os.remove(path)
+            self._insert(key, residual)
+            return residual
+
+    def put(self, client_id: Hashable, layer: Hashable, residual: np.ndarray):
+        """Store a residual, spilling the least recently used ones if needed."""
+        key = (client_id, layer)
+        residual = np.asarray(residual).astype(self.dtype)
+        with self._lock:
+            self.discard(client_id, layer)
+            self._insert(key, residual)
+
+    def discard(self, client_id: Hashable, layer: Hashable):
+        """Forget the residual of a client, if any."""
+        key = (client_id, layer)
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key).nbytes
+            path = self._spilled.pop(key, None)
+            if path is not None:
+                os.remove(path)
+
+    def clear(self):
+        """Forget every residual and remove the spill files."""
+        with self._lock:
+            for path in self._spilled.values():
+                os.remove(path)
+            self._spilled.clear()
+            self._entries.clear()
+            self.nbytes = 0
+
+    def close(self):
+        """Forget every residual and remove the spill directory."""
+        with self._lock:
+            self.clear()
+            if self._spill_tmp is not None:
+                self._spill_tmp.cleanup()
+                self._spill_tmp = None
+            self.spill_dir = None
+
+    def _insert(self, key, residual: np.ndarray):
+        self._entries[key] = residual
+        self.nbytes += residual.nbytes
+        while self.nbytes > self.max_bytes and len(self._entries) > 1:
+            evicted_key, evicted = self._entries.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+            if self.spill_dir is not None:
+                path = os.path.join(self._spill_tmp.name, "residual_%d.npy" % self._num_files)
+                self._num_files += 1
+                spill = np.lib.format.open_memmap(
+                    path, mode="w+", dtype=evicted.dtype, shape=evicted.shape
+                )
+                spill[...] = evicted
+                spill.flush()
+                del spill
+                self._spilled[evicted_key] = path
+
+
+class ErrorFeedback:
+    """Error-feedback wrapper around a compressor.
+
+    Before every compression, the residual a client accumulated for a layer
+    (the part of its earlier updates the compressor dropped) is added back
+    to its new update, and whatever the compressor drops this time becomes
+    the new residual. Nothing is lost, only delayed, which keeps models
+    accurate at much higher space savings.
+
+    Parameters
+    ----------
+    compress : Callable
+        Compression function used by ``compress``, e.g.
+        ``TopKCompressor.compress_sparse``. It gets the corrected update and
+        the keyword arguments given to ``compress`` and returns a np.ndarray
+        or SparseUpdate. Callers that compress on their own only need
+        ``correct`` and ``record``
+    store : ResidualStore
+        Where residuals are kept, defaults to an unbounded float32 store
+    """
+
+    def __init__(self, compress: Callable = None, store: ResidualStore = None):
+        self._compress = compress
+        self.store = ResidualStore(max_bytes=np.inf) if store is None else store
+
+    def correct(self, x: np.ndarray, client_id: Hashable, layer: Hashable) -> np.ndarray:
+        """Return x plus the residual of the client for this layer."""
+        residual = self.store.get(client_id, layer)
+        if residual is None:
+            return x
+        return x + residual.reshape(x.shape)
+
+    def record(
+        self,
+        corrected: np.ndarray,
+        compressed: Union[np.ndarray, SparseUpdate],
+        client_id: Hashable,
+        layer: Hashable,
+    ):
+        """Keep what compressing the corrected update dropped as the residual."""
+        if isinstance(compressed, SparseUpdate):
+            residual = np.array(corrected)
+            compressed.add_to(residual, -1)
+        else:
+            residual = corrected - compressed
+        self.store.put(client_id, layer, residual)
+
+    def compress(self, x: np.ndarray, client_id: Hashable, layer: Hashable, **kwargs):
+        """Compress x with error feedback, kwargs go to the compressor."""
+        corrected = self.correct(x, client_id, layer)
+        compressed = self._compress(corrected, **kwargs)
+        self.record(corrected, compressed, client_id, layer)
+        return compressed
+
+
 if __name__ == "__main__":
     print("Import these functions as a module. This is not meant to be run directly.")
@@ -1,5 +1,8 @@
 #!/usr/bin/env python
 
+import gc
+import itertools
+import tracemalloc
 import pytest
 import compressors
 import numpy as np
@@ -42,3 +45,333 @@ def test_stc():
     actual = compressors.SparseTernaryCompressor.compress(x=x, k=8)
     expected = np.array([-3.5, -3.5, -3.5, -3.5, 0, 0, 3.5, 3.5, 3.5, 3.5])
     np.testing.assert_array_equal(x=actual, y=expected, verbose=True)
+
+
+@pytest.mark.parametrize("b", [1, 2, 3])
+def test_compress_b_sorted_matches_dense(b):
+    rng = np.random.default_rng(b)
+    dense_fn = lambda x: np.square(np.abs(x))
+    # Integer data puts points on (rounded) midpoints between centroids
+    for g in [rng.normal(size=(1000, 1)), rng.integers(-6, 7, size=(1000, 1)),
+              np.array([-4, -3, -3, -1, -2, -1, 4, -5, 2]).reshape(-1, 1)]:
+        for budget in [20, 300, 5000]:
+            obj, l, theta = compressors.compress_b(g, b, budget)
+            dense_obj, dense_l, dense_theta = compressors.compress_b(
+                g, b, budget, dist_fn=dense_fn
+            )
+            np.testing.assert_array_equal(l, dense_l)
+            np.testing.assert_allclose(theta, dense_theta)
+            np.testing.assert_allclose(obj, dense_obj)
+
+
+def test_midpoint_labels_match_dense():
+    # Exact midpoints, rounded midpoints (2.0 between 4/3 and 8/3) and
+    # duplicate centroids, in an order where ties pick the higher centroid
+    theta = np.array([0.0, 3.0, 8 / 3, 1.0, 4 / 3, -2.0, 3.0])
+    x = np.concatenate([np.arange(-3, 5), np.arange(-3, 5) + 0.5, [2.0, -1.0, 2.0]])
+    expected = np.argmin(np.square(x[:, np.newaxis] - theta), axis=1)
+
+    data = compressors._sort_1d(x)
+    ids, bounds = compressors._segment_bounds(data.xs, theta)
+    np.testing.assert_array_equal(compressors._sorted_labels(data.order, ids, bounds), expected)
+    np.testing.assert_array_equal(compressors._nearest_labels(x, theta), expected)
+
+
+def test_compress_b_exact_is_optimal():
+    x = np.array([-2.5, -1.0, -0.2, 0.1, 0.4, 1.5, 2.0])
+    b, budget = 2, 8
+    obj, l, theta = compressors.compress_b(x.reshape(-1, 1), b, budget, exact=True)
+
+    best = np.inf
+    for labels in itertools.product(range(2 ** b), repeat=x.size):
+        labels = np.array(labels)
+        if np.count_nonzero(labels) > budget / b:
+            continue
+        cost = np.square(x[labels == 0]).sum()
+        for j in range(1, 2 ** b):
+            members = x[labels == j]
+            if members.size:
+                cost += np.square(members - members.mean()).sum()
+        best = min(best, cost)
+
+    assert theta[0] == 0
+    assert np.count_nonzero(l) <= budget / b
+    np.testing.assert_allclose(obj, best)
+    np.testing.assert_allclose(np.square(x - theta[l]).sum(), obj)
+
+
+def test_calc_cluster_means():
+    data = np.array([1.0, 2.0, 3.0, 10.0, 0.0])
+    labels = np.array([1, 1, 3, 3, 0])
+    centroids = np.array([5.0, 5.0, 5.0, 5.0])
+    means, counts = compressors.calc_cluster_means(
+        centroids, labels, data.reshape(-1, 1), return_counts=True
+    )
+    np.testing.assert_array_equal(means, [0.0, 1.5, 0.0, 6.5])
+    np.testing.assert_array_equal(counts, [1, 2, 0, 2])
+    # Known cluster sizes are used as they are
+    means = compressors.calc_cluster_means(
+        centroids, labels, data.reshape(-1, 1), counts=np.array([1, 1, 0, 2])
+    )
+    np.testing.assert_array_equal(means, [0.0, 3.0, 0.0, 6.5])
+
+
+def test_sparse_kmeans_deeper_search():
+    rng = np.random.default_rng(0)
+    g = rng.normal(size=5000)
+    _, shallow_error, shallow_b = compressors.sparse_kmeans(g, budget=4000)
+    Cg, deep_error, deep_b = compressors.sparse_kmeans(g, budget=4000, max_bits=8)
+    assert shallow_b <= deep_b <= 8
+    assert deep_error <= shallow_error
+    assert Cg.shape == g.shape
+    assert len(np.unique(Cg)) <= 2 ** deep_b
+
+
+@pytest.mark.parametrize("approx", ["sample", "sketch"])
+def test_sparse_kmeans_approx(approx):
+    rng = np.random.default_rng(0)
+    g = rng.normal(size=(100000, 1))
+    Cg, error, b = compressors.sparse_kmeans(
+        g, budget=40000, approx=approx, approx_size=4096, rng=rng
+    )
+    assert Cg.shape == g.shape
+    assert len(np.unique(Cg)) <= 2 ** b
+    gap = compressors.approximation_gap(
+        g, budget=40000, approx=approx, approx_size=4096, rng=rng
+    )
+    assert gap < 0.1
+
+
+def test_centroid_cache():
+    rng = np.random.default_rng(0)
+    g = rng.normal(size=2000)
+    cache = compressors.CentroidCache()
+    compressors.sparse_kmeans(g, budget=1000, cache=cache, cache_key=(7, 6))
+    assert cache.hits == 0 and len(cache) > 0
+    compressors.sparse_kmeans(g, budget=1000, cache=cache, cache_key=(7, 6))
+    assert cache.hits > 0
+    assert cache.get(7, 6, 1).shape == (2,)
+    assert cache.get(8, 6, 1) is None
+
+    small = compressors.CentroidCache(max_bytes=2 * cache.nbytes // len(cache))
+    for client_id in range(5):
+        small.put(client_id, 6, 1, np.zeros(2))
+    assert len(small) == 2
+    assert small.get(0, 6, 1) is None and small.get(4, 6, 1) is not None
+
+    # Keys and dict bookkeeping count towards the cap, not only the centroids
+    tracemalloc.start()
+    try:
+        many = compressors.CentroidCache()
+        for client_id in range(2000):
+            many.put("client%d" % client_id, 6, 2, np.zeros(4))
+        assert many.nbytes >= tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+
+
+def test_compress_batch():
+    rng = np.random.default_rng(0)
+    X = rng.normal(size=(5, 100))
+    for k in [0, 10, 100]:
+        CX = compressors.TopKCompressor.compress_batch(X, k)
+        SX = compressors.SparseTernaryCompressor.compress_batch(X, max(k, 1))
+        RX = compressors.RandKCompressor.compress_batch(X, k, rng=rng)
+        for x, cx, sx, rx in zip(X, CX, SX, RX):
+            np.testing.assert_array_equal(cx, compressors.TopKCompressor.compress(x, k))
+            np.testing.assert_allclose(
+                sx, compressors.SparseTernaryCompressor.compress(x, max(k, 1))
+            )
+            assert np.count_nonzero(rx) == k
+            np.testing.assert_array_equal(rx[rx != 0], x[rx != 0])
+
+
+def test_sparse_kmeans_batch_matches_rows():
+    rng = np.random.default_rng(0)
+    X = rng.normal(size=(4, 3000)) * rng.random((4, 1))
+    CX, errors, bits = compressors.sparse_kmeans_batch(X, budget=2000, max_bits=4)
+    for x, cx, error, b in zip(X, CX, errors, bits):
+        Cx, expected_error, expected_b = compressors.sparse_kmeans(x, budget=2000, max_bits=4)
+        assert b == expected_b
+        np.testing.assert_allclose(cx, Cx)
+        np.testing.assert_allclose(error, expected_error)
+
+
+def test_sparse_update():
+    x = np.array([-5, -4, -3, -2, -1, 1, 2, 3, 4, 5], dtype=np.float32)
+    Cx = compressors.TopKCompressor.compress_sparse(x=x, k=8)
+    assert isinstance(Cx, compressors.SparseUpdate)
+    assert Cx.nnz == 8 and Cx.nbytes == 8 * (8 + 4)
+    assert compressors.TopKCompressor.getsizeof(Cx) == Cx.nbytes
+    np.testing.assert_array_equal(Cx.toarray(), compressors.TopKCompressor.compress(x=x, k=8))
+    np.testing.assert_array_equal(np.asarray(Cx.reshape((2, 5))), Cx.toarray().reshape(2, 5))
+
+    Sx = compressors.SparseTernaryCompressor.compress_sparse(x=x, k=8)
+    np.testing.assert_array_equal(Sx.toarray(), compressors.SparseTernaryCompressor.compress(x=x, k=8))
+
+    Rx = compressors.RandKCompressor.compress_sparse(x=x, k=3)
+    assert np.count_nonzero(Rx) == 3
+
+    out = np.ones(10)
+    Cx.add_to(out, weight=2)
+    np.testing.assert_array_equal(out, 1 + 2 * Cx.toarray())
+
+    codes = compressors.SparseUpdate([1, 3], [1, 0], (4,), codebook=[-0.5, 0.5])
+    np.testing.assert_array_equal(codes.toarray(), [0, 0.5, 0, -0.5])
+
+
+def test_residual_store(tmp_path):
+    store = compressors.ResidualStore(max_bytes=2 * 400, dtype=np.float16, spill_dir=str(tmp_path))
+    residuals = {c: np.random.normal(size=200) for c in range(4)}
+    for c, residual in residuals.items():
+        store.put(c, 6, residual)
+    assert len(store) == 4 and store.spilled == 2
+    assert store.nbytes <= store.max_bytes
+    spill_dir, = tmp_path.iterdir()
+    assert len(list(spill_dir.iterdir())) == 2
+
+    # Spilled residuals are read back
+    for c, residual in residuals.items():
+        np.testing.assert_allclose(store.get(c, 6), residual, rtol=1e-3, atol=1e-3)
+    assert store.get(0, 7) is None
+
+    store.clear()
+    assert len(store) == 0 and not list(spill_dir.iterdir())
+
+    # Closing or dropping the store removes its spill files
+    for c, residual in residuals.items():
+        store.put(c, 6, residual)
+    assert store.spilled == 2
+    store.close()
+    assert len(store) == 0 and not list(tmp_path.iterdir())
+    store = compressors.ResidualStore(max_bytes=400, spill_dir=str(tmp_path))
+    for c, residual in residuals.items():
+        store.put(c, 6, residual)
+    assert store.spilled == 3
+    del store
+    gc.collect()
+    assert not list(tmp_path.iterdir())
+
+    # Without a spill dir the oldest residuals are dropped
+    store = compressors.ResidualStore(max_bytes=2 * 800)
+    for c, residual in residuals.items():
+        store.put(c, 6, residual)
+    assert store.get(0, 6) is None and store.get(3, 6) is not None
+
+
+@pytest.mark.parametrize("compress", [
+    compressors.TopKCompressor.compress,
+    compressors.TopKCompressor.compress_sparse,
+])
+def test_error_feedback(compress):
+    rng = np.random.default_rng(0)
+    feedback = compressors.ErrorFeedback(compress)
+    updates = rng.normal(size=(20, 500))
+    sent = np.zeros(500)
+    for x in updates:
+        sent += np.asarray(feedback.compress(x, "client", 6, k=25))
+    # Whatever was not sent yet is exactly the residual
+    np.testing.assert_allclose(sent + feedback.store.get("client", 6), updates.sum(axis=0), atol=1e-5)
+
+
+def test_sparse_kmeans_scale():
+    rng = np.random.default_rng(0)
+    g = rng.normal(size=5000).astype(np.float32)
+    budget = int(0.95 * g.size * g.itemsize)
+
+    # Same as clustering the MinMaxScaler-transformed gradient
+    lo, hi = g.min(), g.max()
+    scaled, _, b = compressors.sparse_kmeans(((g - lo) / (hi - lo)).astype(np.float64), budget)
+    Cg, error, b_scaled = compressors.sparse_kmeans(g, budget, scale=True)
+    assert b_scaled == b and Cg.dtype == g.dtype
+    np.testing.assert_allclose(Cg, scaled * (hi - lo) + lo, rtol=1e-5, atol=1e-6)
+
+    S, sparse_error, _ = compressors.sparse_kmeans(g, budget, scale=True, sparse=True)
+    assert S.codebook.size == 2 ** b
+    np.testing.assert_allclose(sparse_error, error, rtol=1e-6)
+    np.testing.assert_array_equal(S.toarray(), Cg)
+
+    X = np.stack([g, -g, g[::-1]])
+    rows, errors, bits = compressors.sparse_kmeans_batch(X, budget, scale=True, sparse=True)
+    for x, row, e, b in zip(X, rows, errors, bits):
+        S, error, b_row = compressors.sparse_kmeans(x, budget, scale=True, sparse=True)
+        assert b == b_row and np.isclose(e, error)
+        np.testing.assert_array_equal(row.codebook, S.codebook)
+        np.testing.assert_array_equal(row.values, S.values)
+
+
+def test_codebook_sse():
+    rng = np.random.default_rng(0)
+    x = rng.normal(size=100000).astype(np.float32)
+    centroids = np.array([0, -1.5, 0.4, 2], dtype=np.float32)
+    labels = rng.integers(0, 4, size=x.size)
+    expected = np.square(x.astype(np.float64) - centroids[labels]).sum()
+    np.testing.assert_allclose(compressors._codebook_sse(x, labels, centroids), expected, rtol=1e-9)
+
+
+@pytest.mark.parametrize("kwargs", [{}, {"scale": True}, {"approx": "sample"}])
+def test_precision(kwargs):
+    rng = np.random.default_rng(0)
+    g = (rng.standard_t(3, size=20000) * 1e-2).astype(np.float32)
+    budget = int(0.95 * g.size * g.itemsize)
+    results = {}
+    try:
+        for precision in ["float64", "float32"]:
+            compressors.set_precision(precision)
+            results[precision] = compressors.sparse_kmeans(
+                g, budget, max_bits=3, rng=np.random.default_rng(1), **kwargs)
+        # float32 data stays float32 in the engine
+        _, _, theta = compressors.compress_b(g, 2, budget)
+        assert theta.dtype == np.float32
+    finally:
+        compressors.set_precision("float32")
+
+    (C64, error64, b64), (C32, error32, b32) = results["float64"], results["float32"]
+    assert b32 == b64 and C32.dtype == C64.dtype == np.float32
+    assert abs(error32 - error64) <= 1e-4 * error64
+
+
+@pytest.mark.parametrize("tol", [0.05, 0.0])
+def test_top_k_approx(tol):
+    rng = np.random.default_rng(0)
+    x = rng.standard_t(3, size=200000).astype(np.float32)
+    k = 20000
+    exact = compressors.TopKCompressor.compress_sparse(x, k)
+    approx, deviation = compressors.TopKCompressor.compress_approx(x, k, sample_size=4096, tol=tol, rng=rng)
+    assert approx.nnz - k == round(deviation * k)
+    assert abs(deviation) <= tol
+    assert np.all(np.diff(approx.indices) > 0)
+    # Everything retained is at least as large as anything dropped
+    dropped = np.ones(x.size, dtype=bool)
+    dropped[approx.indices] = False
+    assert np.abs(approx.values).min() >= np.abs(x[dropped]).max()
+    overlap = np.intersect1d(exact.indices, approx.indices).size
+    assert overlap >= (1 - tol) * k
+
+    # Small vectors fall back to the exact compressor
+    small, deviation = compressors.TopKCompressor.compress_approx(x[:100], 10)
+    assert deviation == 0 and np.array_equal(small.toarray(), compressors.TopKCompressor.compress(x[:100], 10))
+
+
+@pytest.mark.parametrize("block_size", [1, 3, 64])
+def test_rand_k_seeded(block_size):
+    for n, k in [(1, 1), (10, 0), (10, 7), (1000, 100), (1001, 999)]:
+        idxs = compressors.RandKCompressor.seeded_indices(n, k, 7, block_size)
+        assert idxs.size == k and np.all(np.diff(idxs) > 0)
+        assert k == 0 or 0 <= idxs[0] and idxs[-1] < n
+        np.testing.assert_array_equal(idxs, compressors.RandKCompressor.seeded_indices(n, k, 7, block_size))
+
+    # Every entry is about equally likely to be kept
+    kept = np.zeros(1000)
+    for seed in range(500):
+        kept[compressors.RandKCompressor.seeded_indices(1000, 100, seed, block_size)] += 1
+    assert np.all(np.abs(kept / 500 - 0.1) < 0.06)
+
+
+def test_exact_memory_caps():
+    x = np.random.default_rng(0).normal(size=1000)
+    with pytest.raises(AssertionError):
+        compressors.sparse_kmeans(x, budget=400, exact=True, max_bits=compressors.EXACT_MAX_BITS + 1)
+    with pytest.raises(AssertionError):
+        compressors.compress_b(np.zeros(compressors.EXACT_MAX_CELLS // 4 + 1), 2, 400, exact=True)
+    compressors.sparse_kmeans(x, budget=400, exact=True, max_bits=compressors.EXACT_MAX_BITS)
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+
+"""Wire format for compressed client updates.
+
+A ``SparseUpdate`` is serialized to the bytes a client would actually send:
+
+* a fixed header with the dense shape and dtypes,
+* the codebook (if any) and the values, either raw in float16/32/64 or, for
+  codebook updates, as labels bit-packed to ``ceil(log2(len(codebook)))`` bits,
+* the indices, as gaps between consecutive sorted indices coded as LEB128
+  varints. Updates that keep every entry skip the indices altogether, and
+  seeded rand-k updates only send the seed the receiver regenerates them
+  from.
+
+Fixed-width sections come first and are 8-byte aligned, so ``decode`` returns
+values and codebooks that are zero-copy views into the received buffer.
+"""
+
+import struct
+import numpy as np
+
+from compressors import SparseUpdate, RandKCompressor
+
+
+VERSION = 1
+
+# Header: version, flags, value dtype, dense dtype, ndim, padding, nnz, codebook size
+_HEADER = struct.Struct("<BBBBB3xII")
+_FLAG_CODEBOOK = 1
+_FLAG_ALL_INDICES = 2
+_FLAG_SEEDED_INDICES = 4
+
+# Seeded indices: seed, block size
+_INDEX_SEED = struct.Struct("<QI4x")
+
+_DTYPES = [np.dtype(np.float16), np.dtype(np.float32), np.dtype(np.float64)]
+
+
+def _dtype_code(dtype) -> int:
+    """Wire code of a floating point dtype."""
+    dtype = np.dtype(dtype)
+    if dtype not in _DTYPES:
+        # Integer and other updates travel as float32
+        dtype = np.dtype(np.float32)
+    return _DTYPES.index(dtype)
+
+
+def _pad8(n: int) -> int:
+    return -n % 8
+
+
+def encode_varints(values: np.ndarray) -> bytes:
+    """LEB128-encode an array of non-negative integers."""
+    v = np.asarray(values, dtype=np.uint64)
+    num_bytes = np.ones(v.size, dtype=np.intp)
+    rest = v >> np.uint64(7)
+    while rest.any():
+        num_bytes += rest > 0
+        rest >>= np.uint64(7)
+
+    out = np.empty(num_bytes.sum(), dtype=np.uint8)
+    starts = np.cumsum(num_bytes) - num_bytes
+    for j in range(int(num_bytes.max(initial=0))):
+        has_byte = num_bytes > j
+        group = (v[has_byte] >> np.uint64(7 * j)) & np.uint64(0x7F)
+        more = (num_bytes[has_byte] > j + 1).astype(np.uint64) << np.uint64(7)
+        out[starts[has_byte] + j] = group | more
+    return out.tobytes()
+
+
+def decode_varints(buf, count: int) -> np.ndarray:
+    """Decode ``count`` LEB128 varints from the start of buf."""
+    b = np.frombuffer(buf, dtype=np.uint8)
+    ends = np.flatnonzero(b < 0x80)[:count]
+    if count == 0:
+        return np.zeros(0, dtype=np.uint64)
+    b = b[: ends[-1] + 1]
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    shift = np.arange(b.size) - np.repeat(starts, ends - starts + 1)
+    groups = (b & 0x7F).astype(np.uint64) << (np.uint64(7) * shift.astype(np.uint64))
+    return np.add.reduceat(groups, starts)
+
+
+def _bits_for(codebook_size: int) -> int:
+    return max(1, int(np.ceil(np.log2(max(codebook_size, 2)))))
+
+
+def _label_dtype(codebook_size: int) -> np.dtype:
+    """Smallest unsigned dtype holding labels into a codebook of this size."""
+    return np.min_scalar_type(max(codebook_size - 1, 0))
+
+
+def _pack_labels(labels: np.ndarray, bits: int) -> bytes:
+    """Pack labels to bits each, least significant bit first.
+
+    Bit j of label i is bit ``i * bits + j`` of the little-endian bit stream.
+    The stream is built one bit-plane at a time in uint8, so the temporaries
+    take about ``bits + 1`` bytes per label.
+    """
+    stream = np.empty(labels.size * bits, dtype=np.uint8)
+    for j in range(bits):
+        stream[j::bits] = (labels >> j) & 1
+    return np.packbits(stream, bitorder="little").tobytes()
+
+
+def _unpack_labels(buf, count: int, bits: int, dtype) -> np.ndarray:
+    """Inverse of _pack_labels, into labels of the given unsigned dtype."""
+    stream = np.unpackbits(np.frombuffer(buf, dtype=np.uint8), count=count * bits, bitorder="little")
+    labels = np.zeros(count, dtype=dtype)
+    for j in range(bits):
+        labels |= stream[j::bits].astype(dtype, copy=False) << dtype.type(j)
+    return labels
+
+
+def encode(update, value_dtype=None) -> bytes:
+    """Serialize a compressed update.
+
+    Args:
+        update: SparseUpdate or dense np.ndarray (only its nonzeros are sent).
+        value_dtype: dtype the values and codebook are sent in, defaults to
+            the update's own dtype. float16 halves the value bytes at some
+            loss of precision.
+    Return:
+        bytes of the encoded update.
+    """
+    if not isinstance(update, SparseUpdate):
+        update = SparseUpdate.from_dense(np.asarray(update))
+
+    indices, values = update.indices, update.values
+    if indices.size > 1 and np.any(indices[1:] <= indices[:-1]):
+        order = np.argsort(indices, kind="stable")
+        indices, values = indices[order], values[order]
+
+    has_codebook = update.codebook is not None
+    value_code = _dtype_code(value_dtype or (update.codebook.dtype if has_codebook else update.dtype))
+    wire_dtype = _DTYPES[value_code]
+    all_indices = indices.size == update.size
+    seeded = update.index_seed is not None and not all_indices
+    flags = ((_FLAG_CODEBOOK if has_codebook else 0) | (_FLAG_ALL_INDICES if all_indices else 0)
+             | (_FLAG_SEEDED_INDICES if seeded else 0))
+    codebook_size = update.codebook.size if has_codebook else 0
+
+    parts = [
+        _HEADER.pack(VERSION, flags, value_code, _dtype_code(update.dtype),
+                     len(update.shape), indices.size, codebook_size),
+        np.asarray(update.shape, dtype="<u4").tobytes(),
+    ]
+    parts.append(bytes(_pad8(sum(map(len, parts)))))
+
+    if has_codebook:
+        codebook = update.codebook.astype(wire_dtype).tobytes()
+        bits = _bits_for(codebook_size)
+        labels = _pack_labels(values.astype(_label_dtype(codebook_size), copy=False), bits)
+        parts += [codebook, bytes(_pad8(len(codebook))), labels, bytes(_pad8(len(labels)))]
+    else:
+        data = values.astype(wire_dtype).tobytes()
+        parts += [data, bytes(_pad8(len(data)))]
+
+    if seeded:
+        parts.append(_INDEX_SEED.pack(*update.index_seed))
+    elif not all_indices:
+        gaps = np.diff(indices, prepend=-1) - 1
+        parts.append(encode_varints(gaps))
+
+    return b"".join(parts)
+
+
+def decode(buf) -> SparseUpdate:
+    """Deserialize an update produced by encode.
+
+    Values and codebook are read-only views into buf, nothing is copied
+    except the decoded indices and the unpacked labels, which come back in
+    the smallest unsigned dtype that holds them (uint8 for up to 8 bits).
+    """
+    buf = memoryview(buf)
+    version, flags, value_code, dtype_code, ndim, nnz, codebook_size = _HEADER.unpack_from(buf)
+    assert version == VERSION, "unsupported wire format version %d" % version
+    offset = _HEADER.size
+    shape = tuple(int(d) for d in np.frombuffer(buf, dtype="<u4", count=ndim, offset=offset))
+    offset += 4 * ndim
+    offset += _pad8(offset)
+    wire_dtype = _DTYPES[value_code]
+
+    codebook = None
+    if flags & _FLAG_CODEBOOK:
+        codebook = np.frombuffer(buf, dtype=wire_dtype, count=codebook_size, offset=offset)
+        offset += codebook.nbytes
+        offset += _pad8(offset)
+        bits = _bits_for(codebook_size)
+        num_packed = (nnz * bits + 7) // 8
+        values = _unpack_labels(buf[offset:offset + num_packed], nnz, bits, _label_dtype(codebook_size))
+        offset += num_packed
+    else:
+        values = np.frombuffer(buf, dtype=wire_dtype, count=nnz, offset=offset)
+        offset += values.nbytes
+    offset += _pad8(offset)
+
+    index_seed = None
+    if flags & _FLAG_ALL_INDICES:
+        indices = np.arange(nnz)
+    elif flags & _FLAG_SEEDED_INDICES:
+        index_seed = _INDEX_SEED.unpack_from(buf, offset)
+        indices = RandKCompressor.seeded_indices(int(np.prod(shape)), nnz, *index_seed)
+    else:
+        gaps = decode_varints(buf[offset:], nnz).astype(np.int64)
+        indices = np.cumsum(gaps + 1) - 1
+
+    return SparseUpdate(indices, values, shape, _DTYPES[dtype_code], codebook, index_seed)
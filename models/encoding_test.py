@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+
+import numpy as np
+import compressors
+import encoding
+
+
+def test_varints():
+    values = np.array([0, 1, 127, 128, 300, 2 ** 40])
+    encoded = encoding.encode_varints(values)
+    assert len(encoded) == 1 + 1 + 1 + 2 + 2 + 6
+    np.testing.assert_array_equal(encoding.decode_varints(encoded, values.size), values)
+
+
+def test_round_trip_sparse():
+    rng = np.random.default_rng(0)
+    x = rng.normal(size=(100, 30)).astype(np.float32)
+    Cx = compressors.TopKCompressor.compress_sparse(x.ravel(), k=300).reshape(x.shape)
+    buf = encoding.encode(Cx)
+    assert len(buf) < Cx.nbytes
+
+    decoded = encoding.decode(buf)
+    assert decoded.shape == x.shape and decoded.dtype == x.dtype
+    np.testing.assert_array_equal(decoded.toarray(), Cx.toarray())
+    # Values are read straight out of the buffer
+    assert not decoded.values.flags.owndata
+
+    half = encoding.decode(encoding.encode(Cx, value_dtype=np.float16))
+    np.testing.assert_allclose(half.toarray(), Cx.toarray(), rtol=1e-3)
+
+
+def test_round_trip_codebook():
+    rng = np.random.default_rng(0)
+    codebook = np.array([0.0, -0.25, 0.5, 1.0, 2.0], dtype=np.float32)
+    indices = np.sort(rng.choice(10000, size=500, replace=False))
+    labels = rng.integers(1, 5, size=500)
+    update = compressors.SparseUpdate(indices, labels, (10000,), codebook=codebook)
+    buf = encoding.encode(update)
+    # 3-bit labels instead of 4-byte values
+    assert len(buf) < 500 * 3 // 8 + 500 * 2 + 64
+
+    decoded = encoding.decode(buf)
+    np.testing.assert_array_equal(decoded.toarray(), update.toarray())
+
+
+def test_round_trip_dense():
+    x = np.arange(1, 11, dtype=np.float64)
+    decoded = encoding.decode(encoding.encode(x))
+    np.testing.assert_array_equal(decoded.toarray(), x)
+
+
+def test_round_trip_seeded():
+    x = np.random.default_rng(0).normal(size=(300, 40)).astype(np.float32)
+    Cx = compressors.RandKCompressor.compress_seeded(x.ravel(), 1200, seed=2 ** 62 + 5, block_size=16)
+    buf = encoding.encode(Cx.reshape(x.shape))
+    # No index bytes, just the values and the seed
+    assert len(buf) <= 1200 * 4 + 64
+    assert compressors.RandKCompressor.getsizeof(Cx) == 1200 * 4 + 12
+
+    decoded = encoding.decode(buf)
+    assert decoded.index_seed == (2 ** 62 + 5, 16)
+    np.testing.assert_array_equal(decoded.toarray().ravel(), Cx.toarray())
+
+
+def test_ternary_round_trip():
+    rng = np.random.default_rng(3)
+    x = rng.normal(size=4000).astype(np.float32)
+    Sx = compressors.SparseTernaryCompressor.compress_sparse(x, k=400)
+    buf = encoding.encode(Sx)
+    # One bit per label instead of a float per value
+    assert len(buf) < 400 * 4
+    np.testing.assert_array_equal(encoding.decode(buf).toarray(), Sx.toarray())
+
+
+def test_label_packing():
+    rng = np.random.default_rng(4)
+    for codebook_size, dtype in [(2, np.uint8), (5, np.uint8), (128, np.uint8), (300, np.uint16)]:
+        labels = rng.integers(0, codebook_size, size=1001)
+        update = compressors.SparseUpdate(np.arange(0, 3003, 3), labels, (3003,),
+                                          codebook=rng.normal(size=codebook_size))
+        decoded = encoding.decode(encoding.encode(update))
+        assert decoded.values.dtype == dtype
+        np.testing.assert_array_equal(decoded.values, labels)
+        np.testing.assert_array_equal(decoded.toarray(), update.toarray())
@@ -44,7 +44,11 @@ class ClientModel(Model):
         train_op = self.optimizer.minimize(
             loss=loss,
             global_step=tf.train.get_global_step())
-        eval_metric_ops = tf.count_nonzero(tf.equal(labels, predictions["classes"]))
+        correct_pred = tf.equal(labels, predictions["classes"])
+        eval_metric_ops = tf.count_nonzero(correct_pred)
+        self.eval_per_example = (
+            correct_pred,
+            tf.nn.sparse_softmax_cross_entropy_with_logits(labels=labels, logits=logits))
         return features, labels, train_op, eval_metric_ops, loss
 
     def process_x(self, raw_x_batch):
@@ -10,9 +10,12 @@ import tensorflow as tf
 import metrics.writer as metrics_writer
 
 from baseline_constants import MAIN_PARAMS, MODEL_PARAMS
-from client import Client
+from client import Client, DEFAULT_POLICY
+from compression_policy import CompressionPolicy
+from compressors import CentroidCache, ErrorFeedback, ResidualStore, set_precision
 from server import Server
 from model import ServerModel
+from worker_pool import TrainingPool
 
 from utils.args import parse_args
 from utils.model_utils import read_data
@@ -29,6 +32,8 @@ def main():
     np.random.seed(12 + args.seed)
     tf.set_random_seed(123 + args.seed)
 
+    set_precision(args.precision)
+
     model_path = '%s/%s.py' % (args.dataset, args.model)
     if not os.path.exists(model_path):
         print('Please specify a valid dataset and a valid model.')
@@ -56,12 +61,24 @@ def main():
     # Create client model, and share params with server model
     tf.reset_default_graph()
     client_model = ClientModel(args.seed, *model_params)
+    client_model.eval_batch_size = args.eval_batch_size or None
 
-    # Create server
-    server = Server(client_model)
+    # Create server, training on a pool of model replicas if asked to
+    pool = None
+    if args.num_workers > 0:
+        pool = TrainingPool(model_path, args.seed, model_params, args.num_workers)
+    server = Server(client_model, pool, args.delta_density)
 
     # Create clients
-    clients = setup_clients(args.dataset, client_model, args.use_val_set)
+    feedback = None
+    if args.error_feedback:
+        store = ResidualStore(dtype=args.residual_dtype, spill_dir=args.residual_spill_dir)
+        feedback = ErrorFeedback(store=store)
+    policy = CompressionPolicy.from_spec(
+        args.compression_policy, max_workers=args.compression_workers,
+        cache=CentroidCache(), feedback=feedback)
+    print('Compression policy: %s' % policy)
+    clients = setup_clients(args.dataset, client_model, args.use_val_set, policy)
     client_ids, client_groups, client_num_samples = server.get_clients_info(clients)
     print('Clients in Total: %d' % len(clients))
 
@@ -80,7 +97,7 @@ def main():
         c_ids, c_groups, c_num_samples = server.get_clients_info(server.selected_clients)
 
         # Simulate server model training on selected clients' data
-        sys_metrics = server.train_model(num_epochs=args.num_epochs, batch_size=args.batch_size, minibatch=args.minibatch)
+        sys_metrics = server.train_model(num_epochs=args.num_epochs, batch_size=args.batch_size, minibatch=args.minibatch, batch_compress=args.batch_compress, pipeline_depth=args.pipeline_depth)
         sys_writer_fn(i + 1, c_ids, sys_metrics, c_groups, c_num_samples)
         
         # Update server model
@@ -101,22 +118,24 @@ def main():
     print(f'Model sys metrics: {SYS_METRICS_PATH}')
     print(f'Model test metrics: {STAT_METRICS_PATH}')
 
-    # Close models
+    # Close models and remove spilled residuals
     server.close_model()
+    if feedback is not None:
+        feedback.store.close()
 
 def online(clients):
     """We assume all users are always online."""
     return clients
 
 
-def create_clients(users, groups, train_data, test_data, model):
+def create_clients(users, groups, train_data, test_data, model, policy=DEFAULT_POLICY):
     if len(groups) == 0:
         groups = [[] for _ in users]
-    clients = [Client(u, g, train_data[u], test_data[u], model) for u, g in zip(users, groups)]
+    clients = [Client(u, g, train_data[u], test_data[u], model, policy) for u, g in zip(users, groups)]
     return clients
 
 
-def setup_clients(dataset, model=None, use_val_set=False):
+def setup_clients(dataset, model=None, use_val_set=False, policy=DEFAULT_POLICY):
     """Instantiates clients based on given train and test data directories.
 
     Return:
@@ -128,7 +147,7 @@ def setup_clients(dataset, model=None, use_val_set=False):
 
     users, groups, train_data, test_data = read_data(train_data_dir, test_data_dir)
 
-    clients = create_clients(users, groups, train_data, test_data, model)
+    clients = create_clients(users, groups, train_data, test_data, model, policy)
 
     return clients
 
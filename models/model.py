@@ -8,16 +8,34 @@ import tensorflow as tf
 
 from baseline_constants import ACCURACY_KEY
 
-from utils.model_utils import batch_data
+from utils.model_utils import batch_data, ParamLayout
 from utils.tf_utils import graph_size
 
 
+# Examples per sess.run when testing many clients at once
+EVAL_BATCH_SIZE = 1024
+
+
 class Model(ABC):
 
     def __init__(self, seed, lr, optimizer=None):
         self.lr = lr
         self.seed = seed
         self._optimizer = optimizer
+        # (correct, loss) tensors with one entry per example, which
+        # create_model may set to let test_many batch examples across clients
+        self.eval_per_example = None
+        # Examples per sess.run in test and test_many, None to feed all at once
+        self.eval_batch_size = EVAL_BATCH_SIZE
+        self._param_layout = None
+        # Placeholder-fed assign and scatter ops of set_params, built on first use
+        self._assign_placeholders = None
+        self._assign_ops = None
+        self._assign_op = None
+        self._scatter_placeholders = None
+        self._scatter_ops = None
+        # Version of the params last loaded by set_params, None once trained
+        self.params_version = None
 
         self.graph = tf.Graph()
         with self.graph.as_default():
@@ -37,17 +55,93 @@ class Model(ABC):
 
         np.random.seed(self.seed)
 
-    def set_params(self, model_params):
+    def set_params(self, model_params, version=None, delta=None):
+        """Loads model_params into the trainable variables with one sess.run.
+
+        Args:
+            model_params: list of np.ndarray, one per trainable variable.
+            version: version of model_params. If it is the version last
+                loaded and the model has not trained since, nothing is done.
+            delta: optional aggregation.ModelDelta leading to model_params.
+                If the model holds its base version, only the changed
+                entries of its sparse layers are scattered into the session.
+        """
+        if version is not None and version == self.params_version:
+            return
+        if self._assign_op is None:
+            self._build_load_ops()
+        if (delta is not None and self.params_version is not None
+                and delta.base_version == self.params_version):
+            fetches, feed_dict = [], {}
+            for i, (value, layer) in enumerate(zip(model_params, delta.layers)):
+                if layer is None:
+                    fetches.append(self._assign_ops[i])
+                    feed_dict[self._assign_placeholders[i]] = value
+                elif layer.nnz:
+                    indices_ph, values_ph = self._scatter_placeholders[i]
+                    fetches.append(self._scatter_ops[i])
+                    feed_dict[indices_ph] = np.stack(
+                        np.unravel_index(layer.indices, layer.shape), axis=1)
+                    feed_dict[values_ph] = layer.values
+            if fetches:
+                self.sess.run(fetches, feed_dict=feed_dict)
+        else:
+            self.sess.run(self._assign_op,
+                          feed_dict=dict(zip(self._assign_placeholders, model_params)))
+        self.params_version = version
+
+    def _build_load_ops(self):
         with self.graph.as_default():
             all_vars = tf.trainable_variables()
-            for variable, value in zip(all_vars, model_params):
-                variable.load(value, self.sess)
+            self._assign_placeholders = [
+                tf.placeholder(v.dtype.base_dtype, shape=v.shape) for v in all_vars]
+            self._assign_ops = [
+                v.assign(ph) for v, ph in zip(all_vars, self._assign_placeholders)]
+            self._assign_op = tf.group(*self._assign_ops)
+            self._scatter_placeholders = [
+                (tf.placeholder(tf.int64, shape=[None, v.shape.ndims]),
+                 tf.placeholder(v.dtype.base_dtype, shape=[None]))
+                for v in all_vars]
+            self._scatter_ops = [
+                tf.scatter_nd_update(v, indices_ph, values_ph)
+                for v, (indices_ph, values_ph) in zip(all_vars, self._scatter_placeholders)]
 
     def get_params(self):
         with self.graph.as_default():
             model_params = self.sess.run(tf.trainable_variables())
         return model_params
 
+    @property
+    def param_layout(self):
+        """ParamLayout of the trainable variables in get_flat_params."""
+        if self._param_layout is None:
+            with self.graph.as_default():
+                all_vars = tf.trainable_variables()
+                self._param_layout = ParamLayout(
+                    [v.name for v in all_vars], [v.shape.as_list() for v in all_vars])
+        return self._param_layout
+
+    def get_flat_params(self, out=None):
+        """Reads the trainable variables into one contiguous float32 vector.
+
+        Args:
+            out: preallocated vector to read into, e.g. from
+                param_layout.empty(); a new one is allocated if None.
+        Return:
+            the flat vector, whose layers param_layout.views exposes.
+        """
+        return self.param_layout.flatten(self.get_params(), out)
+
+    def set_flat_params(self, flat_params, version=None):
+        """Loads the trainable variables from a flat vector, see set_params."""
+        self.set_params(self.param_layout.views(flat_params), version)
+
+    @property
+    def param_names(self):
+        """Names of the trainable variables, in the order of get_params."""
+        with self.graph.as_default():
+            return [v.name for v in tf.trainable_variables()]
+
     @property
     def optimizer(self):
         """Optimizer to be used by the model."""
@@ -84,6 +178,7 @@ class Model(ABC):
             update: List of np.ndarray weights, with each weight array
                 corresponding to a variable in the resulting graph
         """
+        self.params_version = None
         for _ in range(num_epochs):
             self.run_epoch(data, batch_size)
 
@@ -105,24 +200,92 @@ class Model(ABC):
                         self.labels: target_data
                     })
 
-    def test(self, data):
+    def test(self, data, batch_size=None):
         """
         Tests the current model on the given data.
 
+        The data is processed and fed in chunks of batch_size examples, so
+        peak memory does not grow with the client. See _eval_sums for how
+        the metrics are accumulated.
+
         Args:
             data: dict of the form {'x': [list], 'y': [list]}
+            batch_size: examples per chunk, defaults to self.eval_batch_size.
         Return:
             dict of metrics that will be recorded by the simulation.
         """
-        x_vecs = self.process_x(data['x'])
-        labels = self.process_y(data['y'])
+        num_samples = len(data['y'])
+        tot_acc, tot_loss = self._eval_sums(
+            data['x'], data['y'], batch_size or self.eval_batch_size,
+            np.zeros(num_samples, dtype=np.intp), 1)
+        return {ACCURACY_KEY: float(tot_acc[0]) / num_samples, 'loss': tot_loss[0] / num_samples}
+
+    def test_many(self, datasets, batch_size=None):
+        """
+        Tests the current model on the data of many clients at once.
+
+        The examples of all clients are streamed through the graph in batches
+        of batch_size, and the per-example correctness and loss are summed per
+        client with segment reductions over the client offsets. Models without
+        eval_per_example ops are tested one client at a time.
+
+        Args:
+            datasets: list of dicts of the form {'x': [list], 'y': [list]}
+            batch_size: number of examples fed per sess.run, defaults to
+                self.eval_batch_size.
+        Return:
+            list with the metrics test returns for each dataset.
+        """
+        if self.eval_per_example is None:
+            return [self.test(data, batch_size) for data in datasets]
+
+        counts = np.array([len(data['y']) for data in datasets], dtype=np.intp)
+        xs = [x for data in datasets for x in data['x']]
+        ys = [y for data in datasets for y in data['y']]
+        segments = np.repeat(np.arange(len(datasets)), counts)
+        tot_acc, tot_loss = self._eval_sums(
+            xs, ys, batch_size or self.eval_batch_size or EVAL_BATCH_SIZE,
+            segments, len(datasets))
+        return [{ACCURACY_KEY: float(acc) / n, 'loss': loss / n}
+                for acc, loss, n in zip(tot_acc, tot_loss, counts)]
+
+    def _eval_sums(self, xs, ys, batch_size, segments, num_segments):
+        """Correct counts and loss sums of the examples, per segment.
+
+        The examples are fed in chunks of batch_size (all at once if None),
+        segments[i] being the segment example i counts towards. With
+        eval_per_example ops the per-example losses are summed in float64,
+        so the result does not depend on the chunking beyond float64
+        rounding. Otherwise there must be a single segment, and the mean
+        loss of every chunk is weighted by its size.
+
+        Return:
+            float64 arrays with the correct count and loss sum of every segment
+        """
+        num_samples = len(ys)
+        batch_size = batch_size or max(num_samples, 1)
+        tot_acc = np.zeros(num_segments)
+        tot_loss = np.zeros(num_segments)
         with self.graph.as_default():
-            tot_acc, loss = self.sess.run(
-                [self.eval_metric_ops, self.loss],
-                feed_dict={self.features: x_vecs, self.labels: labels}
-            )
-        acc = float(tot_acc) / x_vecs.shape[0]
-        return {ACCURACY_KEY: acc, 'loss': loss}
+            for start in range(0, num_samples, batch_size):
+                stop = min(start + batch_size, num_samples)
+                feed_dict = {
+                    self.features: self.process_x(xs[start:stop]),
+                    self.labels: self.process_y(ys[start:stop])
+                }
+                if self.eval_per_example is None:
+                    assert num_segments == 1, "summing per segment requires eval_per_example"
+                    acc, loss = self.sess.run([self.eval_metric_ops, self.loss], feed_dict=feed_dict)
+                    tot_acc[0] += int(acc)
+                    # The loss is averaged over the chunk
+                    tot_loss[0] += np.float64(loss) * (stop - start)
+                else:
+                    correct, losses = self.sess.run(self.eval_per_example, feed_dict=feed_dict)
+                    chunk = segments[start:stop]
+                    tot_acc += np.bincount(chunk, weights=correct, minlength=num_segments)
+                    tot_loss += np.bincount(
+                        chunk, weights=np.asarray(losses, dtype=np.float64), minlength=num_segments)
+        return tot_acc, tot_loss
 
     def close(self):
         self.sess.close()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+import numpy as np
+import pytest
+
+tf = pytest.importorskip("tensorflow")
+
+from aggregation import model_delta
+from synthetic.log_reg import ClientModel
+
+
+INPUT_DIM = 10
+NUM_CLASSES = 5
+
+
+@pytest.fixture
+def model():
+    model = ClientModel(0, 0.1, NUM_CLASSES, INPUT_DIM)
+    yield model
+    model.close()
+
+
+def _data(rng, num_samples):
+    return {'x': rng.normal(size=(num_samples, INPUT_DIM)).tolist(),
+            'y': rng.integers(0, NUM_CLASSES, size=num_samples).tolist()}
+
+
+def test_chunked_test_matches_unchunked(model):
+    data = _data(np.random.default_rng(0), 103)
+    expected = model.test(data)
+    losses = model.sess.run(model.eval_per_example[1], feed_dict={
+        model.features: model.process_x(data['x']), model.labels: model.process_y(data['y'])})
+    np.testing.assert_allclose(expected['loss'], np.mean(losses, dtype=np.float64), rtol=1e-12)
+    for batch_size in [1, 10, 64]:
+        metrics = model.test(data, batch_size)
+        assert metrics['accuracy'] == expected['accuracy']
+        np.testing.assert_allclose(metrics['loss'], expected['loss'], rtol=1e-12)
+
+    # Models without per-example ops weight the chunk means
+    model.eval_per_example = None
+    np.testing.assert_allclose(model.test(data, 10)['loss'], expected['loss'], rtol=1e-6)
+
+
+def test_test_many_matches_test(model):
+    rng = np.random.default_rng(1)
+    datasets = [_data(rng, n) for n in [1, 7, 30, 12]]
+    for batch_size in [None, 8]:
+        for metrics, data in zip(model.test_many(datasets, batch_size), datasets):
+            expected = model.test(data)
+            assert metrics['accuracy'] == expected['accuracy']
+            np.testing.assert_allclose(metrics['loss'], expected['loss'], rtol=1e-12)
+
+
+def test_flat_params_round_trip(model):
+    params = model.get_params()
+    out = model.param_layout.empty()
+    flat = model.get_flat_params(out)
+    assert flat is out and flat.size == sum(p.size for p in params)
+    for view, value in zip(model.param_layout.views(flat), params):
+        np.testing.assert_array_equal(view, value)
+
+    model.set_flat_params(2 * flat)
+    for value, expected in zip(model.get_params(), params):
+        np.testing.assert_array_equal(value, 2 * expected)
+
+
+def test_set_params_skips_loaded_version(model):
+    params = model.get_params()
+    changed = [p + 1 for p in params]
+    model.set_params(params, version=1)
+    num_ops = len(model.graph.get_operations())
+
+    # The same version is not loaded again, whatever the values
+    model.set_params(changed, version=1)
+    for value, expected in zip(model.get_params(), params):
+        np.testing.assert_array_equal(value, expected)
+    model.set_params(changed, version=2)
+    for value, expected in zip(model.get_params(), changed):
+        np.testing.assert_array_equal(value, expected)
+    # The load ops are built once
+    assert len(model.graph.get_operations()) == num_ops
+
+    # Training invalidates the loaded version
+    model.train(_data(np.random.default_rng(2), 20))
+    assert model.params_version is None
+    model.set_params(changed, version=2)
+    for value, expected in zip(model.get_params(), changed):
+        np.testing.assert_array_equal(value, expected)
+
+
+def test_set_params_scatters_delta(model):
+    old = model.get_params()
+    new = [p.copy() for p in old]
+    new[0][0, :2] += 1  # Sparse enough to be scattered
+    new[1] += 1  # Loaded whole
+    model.set_params(old, version=1)
+    delta = model_delta(old, new, base_version=1)
+    assert delta.layers[0].nnz == 2 and delta.layers[1] is None
+
+    # Only the changed entries of a scattered layer are read from the delta,
+    # so garbage in its dense value never reaches the session
+    model.set_params([np.zeros_like(new[0]), new[1]], version=2, delta=delta)
+    for value, expected in zip(model.get_params(), new):
+        np.testing.assert_array_equal(value, expected)
+
+    # A delta from another base version is ignored
+    model.set_params(old, version=3)
+    model.set_params(new, version=4, delta=delta)
+    for value, expected in zip(model.get_params(), new):
+        np.testing.assert_array_equal(value, expected)
@@ -0,0 +1,29 @@
+#!/usr/bin/env python
+
+import numpy as np
+
+from utils.model_utils import ParamLayout
+
+
+def test_param_layout():
+    shapes = [(5, 5, 1, 32), (32,), (10, 3), (3,)]
+    names = ["conv/kernel:0", "conv/bias:0", "dense/kernel:0", "dense/bias:0"]
+    layout = ParamLayout(names, shapes)
+    assert len(layout) == 4
+    assert layout.size == sum(int(np.prod(shape)) for shape in shapes)
+    assert layout["dense/kernel:0"].offset == 5 * 5 * 32 + 32
+    assert layout["dense/kernel:0"].shape == (10, 3)
+
+    rng = np.random.default_rng(0)
+    params = [rng.normal(size=shape) for shape in shapes]
+    out = layout.empty()
+    flat = layout.flatten(params, out)
+    assert flat is out and flat.dtype == np.float32
+    views = layout.views(flat)
+    for view, param in zip(views, params):
+        assert view.base is flat
+        np.testing.assert_array_equal(view, param.astype(np.float32))
+
+    # Views write through to the flat vector
+    views[3][:] = 7
+    np.testing.assert_array_equal(flat[-3:], 7)
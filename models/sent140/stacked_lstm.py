@@ -37,13 +37,15 @@ class ClientModel(Model):
         fc1 = tf.layers.dense(inputs=outputs[:, -1, :], units=128)
         pred = tf.layers.dense(inputs=fc1, units=self.num_classes)
         
-        loss = tf.reduce_mean(tf.nn.softmax_cross_entropy_with_logits_v2(logits=pred, labels=labels))
+        example_loss = tf.nn.softmax_cross_entropy_with_logits_v2(logits=pred, labels=labels)
+        loss = tf.reduce_mean(example_loss)
         train_op = self.optimizer.minimize(
             loss=loss,
             global_step=tf.train.get_global_step())
         
         correct_pred = tf.equal(tf.argmax(pred, 1), tf.argmax(labels, 1))
         eval_metric_ops = tf.count_nonzero(correct_pred)
+        self.eval_per_example = (correct_pred, example_loss)
         
         return features, labels, train_op, eval_metric_ops, loss
 
@@ -1,21 +1,38 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
 import numpy as np
 
+from aggregation import WeightedAggregator, model_delta, DELTA_DENSITY
+from client import compress_update, compress_updates
+from encoding import decode
 from baseline_constants import (
         BYTES_WRITTEN_BEFORE_KEY,
         BYTES_WRITTEN_AFTER_KEY,
         SPARSITY_KEY,
         BYTES_READ_KEY,
         TRAIN_TIME_SECS_KEY,
+        DECODE_TIME_SECS_KEY,
         LOCAL_COMPUTATIONS_KEY
         )
 
 class Server:
 
-    def __init__(self, client_model):
+    def __init__(self, client_model, pool=None, delta_density=DELTA_DENSITY):
         self.client_model = client_model
+        # TrainingPool the clients train on, None to train on client_model
+        self.pool = pool
+        # Layers of the global model are loaded as sparse deltas when at most
+        # this fraction of their entries changed, 0 to always load them whole
+        self.delta_density = delta_density
+        # Global model before the last update_model, the base of those deltas
+        self.previous_model = None
         self.model = client_model.get_params()
+        # Bumped whenever self.model changes, lets set_params skip reloads
+        self.model_version = 0
         self.selected_clients = []
-        self.updates = []
+        # Running weighted sum of the round's updates, see update_model
+        self.aggregator = None
 
     def select_clients(self, my_round, possible_clients, num_clients=20):
         """Selects num_clients clients randomly from possible_clients.
@@ -35,7 +52,8 @@ class Server:
 
         return [(c.num_train_samples, c.num_test_samples) for c in self.selected_clients]
 
-    def train_model(self, num_epochs=1, batch_size=10, minibatch=None, clients=None):
+    def train_model(self, num_epochs=1, batch_size=10, minibatch=None, clients=None, batch_compress=False,
+                    pipeline_depth=0):
         """Trains self.model on given clients.
 
         Trains model on self.selected_clients if clients=None;
@@ -48,6 +66,14 @@ class Server:
             batch_size: Size of training batches.
             minibatch: fraction of client's data to apply minibatch sgd,
                 None to use FedAvg
+            batch_compress: if True, the updates of all clients are compressed
+                together with one batched call after everyone has trained.
+                With a TrainingPool, the clients always train first and are
+                compressed afterwards, batched or one by one.
+            pipeline_depth: if > 0, each update is compressed in the background
+                while the next client trains, with at most pipeline_depth
+                updates waiting for compression at any time. Neither a
+                TrainingPool nor batch_compress can be pipelined.
         Return:
             bytes_written: number of bytes written by each client to server
                 dictionary with client ids as keys and integer values.
@@ -63,38 +89,128 @@ class Server:
                    BYTES_WRITTEN_AFTER_KEY: 0,
                    SPARSITY_KEY: 0,
                    TRAIN_TIME_SECS_KEY: 0,
+                   DECODE_TIME_SECS_KEY: 0,
                    BYTES_READ_KEY: 0,
                    LOCAL_COMPUTATIONS_KEY: 0} for c in clients}
+        assert pipeline_depth == 0 or (self.pool is None and not batch_compress), \
+            "pipeline_depth requires training on the shared model without batch_compress"
+        if self.pool is not None:
+            trained = self.pool.train(self.model, list(clients), num_epochs, batch_size, minibatch)
+            return self._compress_trained(clients, trained, sys_metrics, batch_compress)
+        if batch_compress:
+            return self._train_model_batch_compress(clients, sys_metrics, num_epochs, batch_size, minibatch)
+        if pipeline_depth > 0:
+            return self._train_model_pipelined(clients, sys_metrics, num_epochs, batch_size, minibatch, pipeline_depth)
+
         for c in clients:
-            c.model.set_params(self.model)
+            c.model.set_params(self.model, self.model_version)
             #comp, num_samples, update = c.train(num_epochs, batch_size, minibatch)
 
             comp, num_samples, before_nonzeros, after_nonzeros, weighted_sparsity, update, train_time_secs = c.train(num_epochs, batch_size, minibatch)
+            self._record_update(sys_metrics, c, comp, num_samples, before_nonzeros, after_nonzeros, weighted_sparsity, update, train_time_secs)
+
+        return sys_metrics
+
+    def _train_model_batch_compress(self, clients, sys_metrics, num_epochs, batch_size, minibatch):
+        """Trains every client first, then compresses the cohort with compress_updates."""
+        trained = []
+        for c in clients:
+            c.model.set_params(self.model, self.model_version)
+            trained.append(c.local_update(num_epochs, batch_size, minibatch))
+
+        return self._compress_trained(clients, trained, sys_metrics, batch_compress=True)
+
+    def _compress_trained(self, clients, trained, sys_metrics, batch_compress):
+        """Compresses and records the local_update results of the clients."""
+        layer_names = self.client_model.param_names
+        if batch_compress:
+            # Clients share the CompressionPolicy created in main
+            compressed = compress_updates([update for _, _, update, _ in trained],
+                                          clients[0].policy, [c.id for c in clients],
+                                          layer_names)
+        else:
+            compressed = [compress_update(update, c.policy, c.id, layer_names)
+                          for c, (_, _, update, _) in zip(clients, trained)]
+        for c, (comp, num_samples, _, train_time), compressed_update in zip(clients, trained, compressed):
+            before_nonzeros, after_nonzeros, weighted_sparsity, update, compress_time = compressed_update
+            self._record_update(sys_metrics, c, comp, num_samples, before_nonzeros, after_nonzeros, weighted_sparsity, update, train_time + compress_time)
+
+        return sys_metrics
 
-            sys_metrics[c.id][TRAIN_TIME_SECS_KEY] += train_time_secs
-            #sys_metrics[c.id][BYTES_READ_KEY] += c.model.size
-            #sys_metrics[c.id][BYTES_WRITTEN_KEY] += c.model.size
-            sys_metrics[c.id][BYTES_READ_KEY] += np.count_nonzero(np.array(self.model[6]))
-            sys_metrics[c.id][BYTES_WRITTEN_BEFORE_KEY] += before_nonzeros
-            sys_metrics[c.id][BYTES_WRITTEN_AFTER_KEY] += after_nonzeros
-            sys_metrics[c.id][SPARSITY_KEY] += weighted_sparsity
-            sys_metrics[c.id][LOCAL_COMPUTATIONS_KEY] = comp
+    def _train_model_pipelined(self, clients, sys_metrics, num_epochs, batch_size, minibatch, depth):
+        """Trains each client while the previous updates are compressed in the background.
 
-            self.updates.append((num_samples, update))
+        A single worker compresses the updates in the order the clients
+        trained, so error feedback residuals and k-means warm starts evolve
+        exactly as in sequential execution. Once depth updates are waiting,
+        the next client only starts training when the worker catches up.
+        """
+        layer_names = self.client_model.param_names
+        slots = threading.BoundedSemaphore(depth)
+        pending = []
+        with ThreadPoolExecutor(1) as executor:
+            for c in clients:
+                c.model.set_params(self.model, self.model_version)
+                comp, num_samples, update, train_time = c.local_update(num_epochs, batch_size, minibatch)
+                slots.acquire()
+                future = executor.submit(compress_update, update, c.policy, c.id, layer_names)
+                future.add_done_callback(lambda _: slots.release())
+                pending.append((c, comp, num_samples, train_time, future))
+
+                # Record finished updates in client order as soon as possible
+                while pending and pending[0][-1].done():
+                    self._record_compressed(sys_metrics, *pending.pop(0))
+            for entry in pending:
+                self._record_compressed(sys_metrics, *entry)
 
         return sys_metrics
 
+    def _record_compressed(self, sys_metrics, c, comp, num_samples, train_time, future):
+        before_nonzeros, after_nonzeros, weighted_sparsity, update, compress_time = future.result()
+        self._record_update(sys_metrics, c, comp, num_samples, before_nonzeros, after_nonzeros, weighted_sparsity, update, train_time + compress_time)
+
+    def _record_update(self, sys_metrics, c, comp, num_samples, before_nonzeros, after_nonzeros, weighted_sparsity, update, train_time_secs):
+        """Stores a client's compressed update and its system metrics."""
+        sys_metrics[c.id][TRAIN_TIME_SECS_KEY] += train_time_secs
+        #sys_metrics[c.id][BYTES_READ_KEY] += c.model.size
+        #sys_metrics[c.id][BYTES_WRITTEN_KEY] += c.model.size
+        sys_metrics[c.id][BYTES_READ_KEY] += np.count_nonzero(np.array(self.model[6]))
+        sys_metrics[c.id][BYTES_WRITTEN_BEFORE_KEY] += before_nonzeros
+        sys_metrics[c.id][BYTES_WRITTEN_AFTER_KEY] += after_nonzeros
+        sys_metrics[c.id][SPARSITY_KEY] += weighted_sparsity
+        sys_metrics[c.id][LOCAL_COMPUTATIONS_KEY] = comp
+
+        # Compressed layers arrive as encoded bytes
+        decode_start = time.time()
+        update = [decode(v) if isinstance(v, bytes) else v for v in update]
+        sys_metrics[c.id][DECODE_TIME_SECS_KEY] += time.time() - decode_start
+
+        if self.aggregator is None:
+            self.aggregator = WeightedAggregator.like(update)
+        self.aggregator.add(update, num_samples)
+
     def update_model(self):
-        total_weight = 0.
-        base = [0] * len(self.updates[0][1])
-        for (client_samples, client_model) in self.updates:
-            total_weight += client_samples
-            for i, v in enumerate(client_model):
-                base[i] += (client_samples * v.astype(np.float64))
-        averaged_soln = [v / total_weight for v in base]
+        """Replaces the model with the weighted average of the round's updates."""
+        new_model = self.aggregator.result()
+        if self.delta_density > 0:
+            self.previous_model = self.model
+        self.model = new_model
+        self.model_version += 1
+        self.aggregator = None
+
+    def _load_model(self, model):
+        """Loads self.model into model.
 
-        self.model = averaged_soln
-        self.updates = []
+        If model still holds the previous global model, e.g. the evaluation
+        model of a TrainingPool run evaluated every round, the changed
+        entries are found and only those are loaded. Any other model gets
+        the whole params, without comparing anything.
+        """
+        delta = None
+        if (self.previous_model is not None and model.params_version is not None
+                and model.params_version == self.model_version - 1):
+            delta = model_delta(self.previous_model, self.model, model.params_version, self.delta_density)
+        model.set_params(self.model, self.model_version, delta)
 
     def test_model(self, clients_to_test, set_to_use='test'):
         """Tests self.model on given clients.
@@ -105,17 +221,18 @@ class Server:
             clients_to_test: list of Client objects.
             set_to_use: dataset to test on. Should be in ['train', 'test'].
         """
-        metrics = {}
-
         if clients_to_test is None:
             clients_to_test = self.selected_clients
+        if len(clients_to_test) == 0:
+            return {}
 
-        for client in clients_to_test:
-            client.model.set_params(self.model)
-            c_metrics = client.test(set_to_use)
-            metrics[client.id] = c_metrics
+        # The clients share one model, so the global params are loaded once
+        # and the data of all clients is evaluated together
+        model = clients_to_test[0].model
+        self._load_model(model)
+        c_metrics = model.test_many([c.get_data(set_to_use) for c in clients_to_test])
 
-        return metrics
+        return {c.id: m for c, m in zip(clients_to_test, c_metrics)}
 
     def get_clients_info(self, clients):
         """Returns the ids, hierarchies and num_samples for the given clients.
@@ -136,9 +253,11 @@ class Server:
     def save_model(self, path):
         """Saves the server model on checkpoints/dataset/model.ckpt."""
         # Save server model
-        self.client_model.set_params(self.model)
+        self._load_model(self.client_model)
         model_sess =  self.client_model.sess
         return self.client_model.saver.save(model_sess, path)
 
     def close_model(self):
+        if self.pool is not None:
+            self.pool.close()
         self.client_model.close()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+
+import sys
+import numpy as np
+import pytest
+
+from baseline_constants import DECODE_TIME_SECS_KEY
+from client import Client
+from compression_policy import CompressionPolicy
+from compressors import ErrorFeedback, ResidualStore
+from server import Server
+from utils.args import parse_args
+
+
+SHAPES = [(5, 5, 8), (8,), (40, 64), (64,), (64, 10), (10,), (32, 16)]
+
+
+class FakeModel:
+    """Shared model whose training adds a per-client step to the weights."""
+
+    def __init__(self):
+        rng = np.random.default_rng(0)
+        self.params = [rng.normal(size=shape).astype(np.float32) for shape in SHAPES]
+        self.params_version = None
+
+    @property
+    def param_names(self):
+        return ["layer%d:0" % i for i in range(len(SHAPES))]
+
+    def get_params(self):
+        return [p.copy() for p in self.params]
+
+    def set_params(self, model_params, version=None, delta=None):
+        self.params = [np.array(p, dtype=np.float32) for p in model_params]
+        self.params_version = version
+
+    def train(self, data, num_epochs=1, batch_size=10):
+        self.params_version = None
+        rng = np.random.default_rng(int(data['y'][0]))
+        self.params = [p + rng.normal(size=p.shape).astype(np.float32) for p in self.params]
+        return len(data['y']), self.get_params()
+
+
+def _run_round(pipeline_depth):
+    model = FakeModel()
+    policy = CompressionPolicy.from_spec(
+        "6=stc,space_savings=0.9;2=kmeans;4=topk,space_savings=0.8",
+        feedback=ErrorFeedback(store=ResidualStore()))
+    clients = [Client(str(i), train_data={'x': [0] * (i + 1), 'y': [i] * (i + 1)},
+                      model=model, policy=policy) for i in range(5)]
+    server = Server(model)
+    sys_metrics = {}
+    for _ in range(2):
+        sys_metrics = server.train_model(clients=clients, pipeline_depth=pipeline_depth)
+        sums = [acc.copy() for acc in server.aggregator.sums]
+        server.update_model()
+    return sys_metrics, sums, server.model
+
+
+def _without_decode_time(sys_metrics):
+    # Decode time is wall-clock time, everything else must match exactly
+    return {c: {k: v for k, v in m.items() if k != DECODE_TIME_SECS_KEY}
+            for c, m in sys_metrics.items()}
+
+
+def test_pipelined_round_matches_sequential():
+    expected_metrics, expected_sums, expected_model = _run_round(0)
+    for depth in [1, 3]:
+        sys_metrics, sums, global_model = _run_round(depth)
+        assert _without_decode_time(sys_metrics) == _without_decode_time(expected_metrics)
+        for v, w in zip(sums, expected_sums):
+            np.testing.assert_array_equal(v, w)
+        for v, w in zip(global_model, expected_model):
+            np.testing.assert_array_equal(v, w)
+
+
+def test_test_model_loads_params_once():
+    model = FakeModel()
+    loads = []
+    set_params = model.set_params
+    model.set_params = lambda params, version=None, delta=None: loads.append(version) or set_params(params)
+    model.test_many = lambda datasets: [{'accuracy': len(d['y'])} for d in datasets]
+    clients = [Client(str(i), train_data={'x': [0] * i, 'y': [0] * i},
+                      eval_data={'x': [0] * (2 * i), 'y': [0] * (2 * i)}, model=model)
+               for i in range(4)]
+    server = Server(model)
+    assert server.test_model(clients, 'train') == {str(i): {'accuracy': i} for i in range(4)}
+    assert server.test_model(clients, 'test') == {str(i): {'accuracy': 2 * i} for i in range(4)}
+    assert loads == [0, 0]
+
+
+def test_pipeline_depth_needs_sequential_training(monkeypatch):
+    model = FakeModel()
+    clients = [Client("0", train_data={'x': [0], 'y': [0]}, model=model)]
+    for server, batch_compress in [(Server(model, pool=object()), False), (Server(model), True)]:
+        with pytest.raises(AssertionError):
+            server.train_model(clients=clients, batch_compress=batch_compress, pipeline_depth=2)
+
+    for flags in [["--num-workers", "2"], ["--batch-compress"]]:
+        monkeypatch.setattr(sys, "argv", ["main.py", "-dataset", "femnist", "-model", "cnn",
+                                          "--pipeline-depth", "2"] + flags)
+        with pytest.raises(SystemExit):
+            parse_args()
+
+
+def test_model_delta_only_for_previous_version():
+    train_model, eval_model = FakeModel(), FakeModel()
+    deltas = []
+    set_params = eval_model.set_params
+    eval_model.set_params = lambda params, version=None, delta=None: (
+        deltas.append(delta) or set_params(params, version, delta))
+    train_clients = [Client(str(i), train_data={'x': [0], 'y': [i]}, model=train_model) for i in range(2)]
+    eval_clients = [Client("0", eval_data={'x': [0], 'y': [0]}, model=eval_model)]
+    eval_model.test_many = lambda datasets: [{} for _ in datasets]
+    server = Server(train_model)
+    for eval_round in [True, True, False, True]:
+        server.train_model(clients=train_clients)
+        server.update_model()
+        if eval_round:
+            server.test_model(eval_clients)
+    # A delta is only computed when the eval model holds the previous round's model
+    assert [d is None for d in deltas] == [True, False, True]
+    assert deltas[1].base_version == 1
@@ -32,6 +32,7 @@ class ClientModel(Model):
         predictions = tf.argmax(logits, axis=-1)
         correct_pred = tf.equal(predictions, labels)
         eval_metric_ops = tf.count_nonzero(correct_pred)
+        self.eval_per_example = (correct_pred, loss)
         
         return features, labels, train_op, eval_metric_ops, tf.reduce_mean(loss)
 
@@ -49,6 +49,50 @@ def parse_args():
     parser.add_argument('--use-val-set', 
                     help='use validation set;', 
                     action='store_true')
+    parser.add_argument('--batch-compress',
+                    help='compress the updates of all clients of a round in one batched call;',
+                    action='store_true')
+    parser.add_argument('--num-workers',
+                    help='processes training clients on their own model replica, 0 to train on the shared model;',
+                    type=int,
+                    default=0)
+    parser.add_argument('--pipeline-depth',
+                    help='updates compressed in the background while the next client trains, 0 to compress synchronously;',
+                    type=int,
+                    default=0)
+    parser.add_argument('--eval-batch-size',
+                    help='examples per sess.run when evaluating, 0 to feed each client at once;',
+                    type=int,
+                    default=1024)
+    parser.add_argument('--delta-density',
+                    help='load layers of the global model as sparse deltas into a model still holding the previous one when at most this fraction changed, 0 to always load them whole;',
+                    type=float,
+                    default=0.1)
+    parser.add_argument('--compression-policy',
+                    help='layers to compress and how, as a JSON file or layer=compressor,param=value;... spec;',
+                    type=str,
+                    default='6=stc,space_savings=0.90')
+    parser.add_argument('--compression-workers',
+                    help='threads compressing the layers of an update concurrently;',
+                    type=int,
+                    default=None)
+    parser.add_argument('--precision',
+                    help='dtype updates are compressed and aggregated in, float64 to validate against;',
+                    type=str,
+                    choices=['float32', 'float64'],
+                    default='float32')
+    parser.add_argument('--error-feedback',
+                    help='add the compression error of each client back into its next update;',
+                    action='store_true')
+    parser.add_argument('--residual-dtype',
+                    help='dtype error feedback residuals are stored in;',
+                    type=str,
+                    choices=['float32', 'float16'],
+                    default='float32')
+    parser.add_argument('--residual-spill-dir',
+                    help='dir the temporary residual spill files of inactive clients are created in, None to drop them;',
+                    type=str,
+                    default=None)
 
     # Minibatch doesn't support num_epochs, so make them mutually exclusive
     epoch_capability_group = parser.add_mutually_exclusive_group()
@@ -72,4 +116,11 @@ def parse_args():
                     default=-1,
                     required=False)
 
-    return parser.parse_args()
+    args = parser.parse_args()
+    # Pool and batched rounds compress after every client has trained, so
+    # there is no training for compression to overlap with
+    if args.pipeline_depth > 0 and args.num_workers > 0:
+        parser.error('--pipeline-depth cannot be combined with --num-workers')
+    if args.pipeline_depth > 0 and args.batch_compress:
+        parser.error('--pipeline-depth cannot be combined with --batch-compress')
+    return args
@@ -2,6 +2,7 @@ import json
 import numpy as np
 import os
 from collections import defaultdict
+from typing import NamedTuple
 
 
 def batch_data(data, batch_size, seed):
@@ -67,3 +68,61 @@ def read_data(train_data_dir, test_data_dir):
     assert train_groups == test_groups
 
     return train_clients, train_groups, train_data, test_data
+
+
+class ParamSlice(NamedTuple):
+    name: str
+    offset: int
+    shape: tuple
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+
+class ParamLayout:
+    '''Position of every layer of a model in its flat parameter vector.
+
+    Layers are laid out back to back in the order of the trainable
+    variables, each one flattened in C order.
+
+    Args:
+        names: names of the layers
+        shapes: shapes of the layers
+        dtype: dtype of the flat vector
+    '''
+
+    def __init__(self, names, shapes, dtype=np.float32):
+        self.slices = []
+        offset = 0
+        for name, shape in zip(names, shapes):
+            param_slice = ParamSlice(name, offset, tuple(int(d) for d in shape))
+            self.slices.append(param_slice)
+            offset += param_slice.size
+        self.size = offset
+        self.dtype = np.dtype(dtype)
+        self._by_name = {s.name: s for s in self.slices}
+
+    def __getitem__(self, name):
+        return self._by_name[name]
+
+    def __len__(self):
+        return len(self.slices)
+
+    def empty(self):
+        '''Uninitialized flat vector.'''
+        return np.empty(self.size, dtype=self.dtype)
+
+    def flatten(self, params, out=None):
+        '''Copies a list of layers into a flat vector, out if given.'''
+        if out is None:
+            out = self.empty()
+        assert out.shape == (self.size,), 'expected a flat vector of %d entries' % self.size
+        for s, value in zip(self.slices, params):
+            out[s.offset:s.offset + s.size] = np.ravel(value)
+        return out
+
+    def views(self, flat):
+        '''Per-layer views into a flat vector, without copying.'''
+        assert flat.shape == (self.size,), 'expected a flat vector of %d entries' % self.size
+        return [flat[s.offset:s.offset + s.size].reshape(s.shape) for s in self.slices]
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+"""Multi-process client training with one model replica per worker.
+
+Every worker process builds its own ``ClientModel`` once, with its own TF
+graph and session. Each round the selected clients are split into one
+contiguous group per worker, and every worker receives the global params
+once, trains its clients one after another and sends back their raw
+updates. Compression stays in the main process, where the policy's
+warm-start caches and error feedback residuals live.
+
+Before a client trains, ``random`` and ``np.random`` are seeded from the
+run seed, the round and the client id, so the updates do not depend on the
+number of workers or on which worker a client lands on.
+"""
+
+import importlib
+import multiprocessing
+import random
+import zlib
+import numpy as np
+
+from client import Client
+
+
+# The ClientModel replica of this worker process
+_model = None
+
+
+def _init_worker(model_path, seed, model_params):
+    global _model
+    ClientModel = getattr(importlib.import_module(model_path), 'ClientModel')
+    _model = ClientModel(seed, *model_params)
+
+
+def client_seed(seed: int, round_number: int, client_id) -> int:
+    """Seed of a client's local training in a given round."""
+    key = zlib.crc32(str(client_id).encode())
+    return int(np.random.SeedSequence([seed, round_number, key]).generate_state(1)[0])
+
+
+def _train_clients(params, clients, num_epochs, batch_size, minibatch, seed, round_number):
+    results = []
+    for client_id, train_data in clients:
+        _model.set_params(params)
+        s = client_seed(seed, round_number, client_id)
+        random.seed(s)
+        np.random.seed(s)
+        client = Client(client_id, train_data=train_data, model=_model)
+        results.append(client.local_update(num_epochs, batch_size, minibatch))
+    return results
+
+
+class TrainingPool:
+    """Pool of worker processes training clients on their own model replica.
+
+    Parameters
+    ----------
+    model_path : str
+        Module of the ClientModel, e.g. ``"femnist.cnn"``
+    seed : int
+        Run seed, the ClientModel replicas are built with it
+    model_params : tuple
+        Remaining arguments of the ClientModel
+    num_workers : int
+        Number of worker processes
+    """
+
+    def __init__(self, model_path: str, seed: int, model_params: tuple, num_workers: int):
+        assert num_workers >= 1, "num_workers must be at least 1"
+        self.seed = seed
+        self.num_workers = num_workers
+        self.rounds = 0
+        # TF sessions do not survive a fork, so the workers are spawned
+        context = multiprocessing.get_context('spawn')
+        self._pool = context.Pool(num_workers, _init_worker, (model_path, seed, model_params))
+
+    def train(self, params, clients, num_epochs=1, batch_size=10, minibatch=None):
+        """Trains every client from params, like Client.local_update.
+
+        Return:
+            list with one local_update tuple per client, in client order
+        """
+        groups = [group for group in np.array_split(np.arange(len(clients)), self.num_workers) if group.size]
+        tasks = [(params, [(clients[i].id, clients[i].train_data) for i in group],
+                  num_epochs, batch_size, minibatch, self.seed, self.rounds)
+                 for group in groups]
+        results = self._pool.starmap(_train_clients, tasks)
+        self.rounds += 1
+        return [r for group in results for r in group]
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
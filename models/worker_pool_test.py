@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+import random
+import numpy as np
+
+from client import Client
+from server import Server
+from worker_pool import TrainingPool
+
+
+# Server metrics read layer 6 of the model
+SHAPES = [(4, 3), (3,), (6, 2), (2,), (5, 4), (4,), (8, 3)]
+
+
+class ClientModel:
+    """Stand-in for a TF ClientModel whose training draws from random and np.random."""
+
+    def __init__(self, seed, lr):
+        self.lr = lr
+        rng = np.random.default_rng(seed)
+        self.params = [rng.normal(size=shape) for shape in SHAPES]
+
+    def get_params(self):
+        return [p.copy() for p in self.params]
+
+    def set_params(self, model_params, version=None, delta=None):
+        self.params = [np.array(p) for p in model_params]
+
+    def train(self, data, num_epochs=1, batch_size=10):
+        for _ in range(num_epochs):
+            step = random.random() * np.mean(data['y'])
+            self.params = [p + self.lr * step * np.random.normal(size=p.shape) for p in self.params]
+        return len(data['y']), self.get_params()
+
+
+def _train(num_workers):
+    clients = [Client(str(i), train_data={'x': list(range(i + 2)), 'y': list(range(i + 2))})
+               for i in range(7)]
+    pool = TrainingPool(__name__, 0, (0.1,), num_workers)
+    try:
+        params = ClientModel(0, 0.1).get_params()
+        return [pool.train(params, clients, num_epochs=2, minibatch=0.5) for _ in range(2)]
+    finally:
+        pool.close()
+
+
+def test_training_pool_is_deterministic():
+    expected = _train(1)
+    for num_workers in [2, 3]:
+        for round_results, expected_round in zip(_train(num_workers), expected):
+            for (comp, n, update, _), (exp_comp, exp_n, exp_update, _) in zip(round_results, expected_round):
+                assert (comp, n) == (exp_comp, exp_n)
+                for v, w in zip(update, exp_update):
+                    np.testing.assert_array_equal(v, w)
+    # Clients and rounds get their own seeds
+    assert not np.array_equal(expected[0][0][2][0], expected[0][1][2][0])
+    assert not np.array_equal(expected[0][0][2][0], expected[1][0][2][0])
+
+
+def test_server_trains_on_pool():
+    client_model = ClientModel(0, 0.1)
+    clients = [Client(str(i), train_data={'x': [0] * 3, 'y': [i] * 3}, model=client_model)
+               for i in range(4)]
+    pool = TrainingPool(__name__, 0, (0.1,), 2)
+    client_model.param_names = ["layer%d:0" % i for i in range(len(SHAPES))]
+    server = Server(client_model, pool)
+    try:
+        for batch_compress in [False, True]:
+            sys_metrics = server.train_model(clients=clients, batch_compress=batch_compress)
+            assert sorted(sys_metrics) == [c.id for c in clients]
+            assert server.aggregator.count == len(clients)
+            assert server.aggregator.total_weight == 3 * len(clients)
+            server.update_model()
+    finally:
+        server.pool.close()
+